@@ -0,0 +1,379 @@
+#!/usr/bin/python3
+
+# benchmark the stages of tailor.py on generated config trees and tailor files
+# examples:
+#   python3 bench-tailor.py
+#   python3 bench-tailor.py --depth 4 --fan-out 8 --template-size 1000000 --save-baseline bench-baseline.json
+#   python3 bench-tailor.py --depth 4 --fan-out 8 --template-size 1000000 --baseline bench-baseline.json --threshold 0.2
+#   python3 bench-tailor.py --check-resolver --check-trees 1000
+
+import os
+import sys
+import argparse
+import logging
+import traceback
+import copy
+import tempfile
+import shutil
+import json
+import random
+import time
+import yaml
+import tailor
+
+# get command line args
+parser = argparse.ArgumentParser()
+parser.add_argument("--config-files", type=int, default=3, help="number of config files to generate (default 3)", required=False)
+parser.add_argument("--levels", type=int, default=4, help="number of resolvable levels, of environment, account_name, region, vpc, chained in that order (default 4)", required=False)
+parser.add_argument("--depth", type=int, default=2, help="depth resolvable levels are nested in each other (default 2)", required=False)
+parser.add_argument("--fan-out", type=int, default=4, help="number of values of each resolvable level (default 4)", required=False)
+parser.add_argument("--leaf-keys", type=int, default=20, help="number of keys with scalar values per node (default 20)", required=False)
+parser.add_argument("--templates", type=int, default=20, help="number of tailor files to generate (default 20)", required=False)
+parser.add_argument("--template-size", type=int, default=100000, help="size of each tailor file in bytes (default 100000)", required=False)
+parser.add_argument("--token-density", type=float, default=0.2, help="average number of tokens per line (default 0.2)", required=False)
+parser.add_argument("--nesting", type=int, default=2, help="length of chains of config values containing tokens (default 2)", required=False)
+parser.add_argument("--line-length", type=int, default=80, help="length of lines in tailor files (default 80)", required=False)
+parser.add_argument("--repeat", type=int, default=5, help="number of runs of each stage, the fastest is reported (default 5)", required=False)
+parser.add_argument("--jobs", type=int, default=1, help="number of processes used to tailor files (default 1)", required=False)
+parser.add_argument("--seed", type=int, default=0, help="seed for generated configs and tailor files (default 0)", required=False)
+parser.add_argument("--work-dir", type=str, default=None, help="directory to generate files in, kept after the run (default temporary directory)", required=False)
+parser.add_argument("--baseline", type=str, default=None, help="json file of an earlier run to compare timings with (default None)", required=False)
+parser.add_argument("--save-baseline", type=str, default=None, help="json file to save timings of this run to (default None)", required=False)
+parser.add_argument("--threshold", type=float, default=0.25, help="relative slow down compared to --baseline reported as regression (default 0.25)", required=False)
+parser.add_argument("--check-resolver", default=False, help="instead of timing stages, check that resolve_configs gives the same config maps as the previous fixed-point resolver for the tst0 configs, the generated configs and --check-trees random config trees (default false)", required=False, action='store_true')
+parser.add_argument("--check-trees", type=int, default=200, help="number of random config trees for --check-resolver (default 200)", required=False)
+parser.add_argument("--verbose", default=False, help="add verbose messaging (default false)", required=False, action='store_true')
+
+# globals
+RESOLVABLE_LEVELS = ['environment', 'account_name', 'region', 'vpc']
+FILLER_WORDS = ['alpha', 'beta', 'gamma', 'delta', '=', '"', ':', '-', '#', '{', '}', '%', '<value/>', '10.20.30.40/21']
+# stages faster than this are not flagged as regression, their timings are mostly noise
+MIN_REGRESSION_SECONDS = 0.001
+TST0_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tst0')
+TST0_CONFIG_FILES = ['config-first.yml', 'config-second.yml', 'config-third.yml']
+TST0_ENVIRONMENTS = ['dev', 'qa', 'uat', 'preprod', 'prod', 'missing']
+TST0_BRANCHES = ['develop', 'master', 'main', 'release', 'hotfix']
+STAGES = ['read_config_files', 'resolve_configs', 'consolidate_configs', 'print_config_map', 'index_config_map', 'substitue_keys_in_tailor_files']
+
+
+#-------------------------------------------------------------------------------
+# Set up logger
+#-------------------------------------------------------------------------------
+def setup_logger(verbose):
+    log_level = logging.INFO
+    if verbose:
+        log_level = logging.DEBUG
+    logger_format = '%(asctime)s - %(name)s - [%(levelname)s] - %(message)s'
+    logging.basicConfig(format=logger_format, level=log_level)
+    return logging.getLogger(os.path.basename(__file__))
+
+
+#-------------------------------------------------------------------------------
+# generate a config node with leaf keys and, below depth, a value node for each
+# value of the resolvable levels. a value node of a level names the value of the
+# next level, e.g. environment-1 -> account_name: account_name-1
+#-------------------------------------------------------------------------------
+def generate_config_node(rand: random.Random, levels: list, depth: int, fan_out: int, leaf_keys: int, path: str):
+    node = {f"key_{i}": f"{path}-value-{i}-{rand.randrange(10000)}" for i in range(rand.randint(leaf_keys // 2, leaf_keys))}
+    if depth <= 0:
+        return node
+    for level_index, level in enumerate(levels):
+        node[level] = {}
+        for value_index in range(fan_out):
+            value = f"{level}-{value_index}"
+            value_node = generate_config_node(rand, levels, depth - 1, fan_out, leaf_keys, f"{path}.{value}")
+            if level_index + 1 < len(levels):
+                value_node[levels[level_index + 1]] = f"{levels[level_index + 1]}-{value_index}"
+            node[level][value] = value_node
+    return node
+
+
+#-------------------------------------------------------------------------------
+# generate config files, the first holds the defaults with a chain of values
+# containing tokens (chain_0 -> {{ chain_1 }} -> ... -> chain_<nesting>) and
+# nested groups of keys for dotted tokens
+#-------------------------------------------------------------------------------
+def generate_config_files(rand: random.Random, work_dir: str):
+    levels = RESOLVABLE_LEVELS[:args.levels]
+    config_files = []
+    for config_index in range(args.config_files):
+        config = generate_config_node(rand, levels, args.depth, args.fan_out, args.leaf_keys, f"config{config_index}")
+        defaults = {f"key_{i}": f"default-value-{i}" for i in range(args.leaf_keys)}
+        if config_index == 0:
+            for i in range(args.nesting):
+                defaults[f"chain_{i}"] = f"prefix-{i}-{{{{ chain_{i + 1} }}}}"
+            defaults[f"chain_{args.nesting}"] = f"chain-value-{args.nesting}"
+            defaults['nested'] = {f"group_{i}": {f"key_{j}": f"nested-{i}-{j}" for j in range(args.leaf_keys)} for i in range(args.fan_out)}
+        config['defaults'] = defaults
+        config_file = os.path.join(work_dir, f"config-{config_index}.yml")
+        with open(config_file, 'w') as f:
+            yaml.dump({'config': config}, f)
+        config_files.append(config_file)
+    return config_files
+
+
+#-------------------------------------------------------------------------------
+# generate tailor files of lines of filler words with tokens, one in five
+# tokens is a dotted path in to the nested groups of keys and one in ten the
+# start of the chain of tokens
+#-------------------------------------------------------------------------------
+def generate_tailor_files(rand: random.Random, work_dir: str):
+    template_dir = os.path.join(work_dir, 'tailor-template')
+    os.makedirs(template_dir, exist_ok=True)
+    tailor_files = []
+    for template_index in range(args.templates):
+        lines = []
+        size = 0
+        while size < args.template_size:
+            words = []
+            line_size = 0
+            while line_size < args.line_length:
+                if rand.random() < args.token_density * 8 / args.line_length:
+                    token_type = rand.random()
+                    if token_type < 0.1:
+                        word = "{{ chain_0 }}"
+                    elif token_type < 0.3:
+                        word = f"{{{{ nested.group_{rand.randrange(args.fan_out)}.key_{rand.randrange(args.leaf_keys)} }}}}"
+                    else:
+                        word = f"{{{{ key_{rand.randrange(args.leaf_keys)} }}}}"
+                else:
+                    word = rand.choice(FILLER_WORDS)
+                words.append(word)
+                line_size += len(word) + 1
+            lines.append(' '.join(words))
+            size += line_size
+        tailor_file = os.path.join(template_dir, f"template-{template_index}.txt")
+        with open(tailor_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        tailor_files.append(tailor_file)
+    return tailor_files
+
+
+#-------------------------------------------------------------------------------
+# run a stage repeat times and return fastest time in seconds and the result
+#-------------------------------------------------------------------------------
+def time_stage(stage, get_stage_args):
+    timings = []
+    for _ in range(args.repeat):
+        stage_args = get_stage_args()
+        start_time = time.perf_counter()
+        result = stage(*stage_args)
+        timings.append(time.perf_counter() - start_time)
+    return (min(timings), result)
+
+
+#-------------------------------------------------------------------------------
+# time each stage of tailor.py on the generated files
+#-------------------------------------------------------------------------------
+def run_benchmark(config_files: list, tailor_files: list, work_dir: str):
+    resolvable_keys = tailor.get_resolvable_keys_list([":AWS_DEFAULT:"])
+    defaults = {'environment': 'environment-0'}
+    timings = {}
+    (timings['read_config_files'], configs) = time_stage(tailor.read_config_files, lambda: (config_files,))
+    (timings['resolve_configs'], _) = time_stage(tailor.resolve_configs, lambda: (resolvable_keys, configs, dict(defaults)))
+    resolved_keys = dict(defaults)
+    resolved_config = tailor.resolve_configs(resolvable_keys, configs, resolved_keys)
+    (timings['consolidate_configs'], config_map) = time_stage(tailor.consolidate_configs, lambda: (copy.deepcopy(resolved_config), dict(resolved_keys)))
+    (timings['print_config_map'], _) = time_stage(tailor.print_config_map, lambda: (os.path.join(work_dir, 'tailor.yml'), config_map))
+    (timings['index_config_map'], config_index) = time_stage(tailor.index_config_map, lambda: (config_map,))
+    (timings['substitue_keys_in_tailor_files'], _) = time_stage(tailor.substitue_keys_in_tailor_files, lambda: (tailor_files, config_map, dict(config_index), args.jobs))
+    return timings
+
+
+#-------------------------------------------------------------------------------
+# previous resolver of tailor.py, visiting every config again until a whole
+# pass over all configs does not resolve anything. changes the configs it is
+# given
+#-------------------------------------------------------------------------------
+def resolve_configs_fixed_point(resolvable_keys: list, configs: list, resolved_keys: dict):
+    fully_resolved = False
+    while not fully_resolved:
+        fully_resolved = True
+        for config in configs:
+            logger.debug(f"Parsing config tree for {config['resolved']['source_config_file']}")
+            resolution_occured = colapse_and_get_ordered_list_keys(resolvable_keys, config, resolved_keys)
+            if resolution_occured:
+                fully_resolved = False
+    return configs
+
+
+#-------------------------------------------------------------------------------
+# iterate through keys in tree that match resolvable_keys (descending) and find
+# element matching value for specified key, and bring back to top level
+# as default keys
+#-------------------------------------------------------------------------------
+def colapse_and_get_ordered_list_keys(resolvable_keys: list, config_node: map, resolved_keys: dict):
+    tailor.move_leaf_keys_to_resolved_key_list(config_node)
+    resolution_occured = False
+    for key in list(config_node):
+        if key in ['resolved', 'defaults']:
+            continue
+        if key not in resolvable_keys:
+            logger.debug(f"Unknown element structure '{key}' at top level")
+            continue
+        node = config_node[key]
+        tailor.move_leaf_keys_to_resolved_key_list(node)
+        for resolvable_key in resolvable_keys:
+            if key == resolvable_key:                                               # is key that should be resolvable
+                if key in resolved_keys:                                            # key has resolvable value
+                    tailor.merge_keys(node['defaults'], node['resolved'], True)
+                    tailor.merge_keys(config_node['defaults'], node['defaults'], True)
+                    if resolved_keys[key] not in node:                              # value does not exist in list, cannot be resolved
+                        del(config_node[key])                                       # delete key
+                        resolution_occured = True
+                        continue
+
+                    resolved_node = node[resolved_keys[key]]
+                    resolution_occured = colapse_and_get_ordered_list_keys(resolvable_keys, resolved_node, resolved_keys)
+
+                    # if there are unresolved sub structures that are resolvable, do no delete this node
+                    tailor.move_leaf_keys_to_resolved_key_list(resolved_node)
+                    tailor.merge_keys(resolved_node['defaults'], resolved_node['resolved'], True)
+                    tailor.merge_keys(node['defaults'], resolved_node['defaults'], True)
+                    tailor.merge_keys(config_node['defaults'], node['defaults'], True)
+                    tailor.update_resolved_keys(config_node['defaults'], resolvable_keys, resolved_keys)
+                    if tailor.check_for_unresolved_resolvable_keys(resolvable_keys, resolved_node):
+                        logger.debug(f"found more ordered keys in {resolved_keys[key]}")
+                        break
+
+                    del(config_node[key])
+                    resolution_occured = True
+
+    return resolution_occured
+
+
+#-------------------------------------------------------------------------------
+# resolve configs with both resolvers and compare resulting config maps,
+# returns True if they are the same
+#-------------------------------------------------------------------------------
+def check_resolver(name: str, resolvable_keys: list, configs: list, resolved_keys: dict):
+    results = []
+    for resolver in [tailor.resolve_configs, resolve_configs_fixed_point]:
+        resolver_resolved_keys = dict(resolved_keys)
+        # previous resolver changes configs it is given
+        resolver_configs = configs if resolver is tailor.resolve_configs else copy.deepcopy(configs)
+        resolved_config = resolver(resolvable_keys, resolver_configs, resolver_resolved_keys)
+        results.append((tailor.consolidate_configs(resolved_config, resolver_resolved_keys), resolver_resolved_keys))
+    if yaml.dump(results[0]) == yaml.dump(results[1]):
+        return True
+    (index, fixed_point_index) = [tailor.index_config_map(config_map) for (config_map, _) in results]
+    for key in sorted(set(index) | set(fixed_point_index)):
+        if index.get(key) != fixed_point_index.get(key):
+            logger.error(f"ERROR: {name}: '{key}' resolved to {index.get(key)!r}, fixed-point resolver gives {fixed_point_index.get(key)!r}")
+    if results[0][1] != results[1][1]:
+        logger.error(f"ERROR: {name}: resolved keys {results[0][1]}, fixed-point resolver gives {results[1][1]}")
+    return False
+
+
+#-------------------------------------------------------------------------------
+# generate parsed configs of random shape, with resolvable levels in random
+# order, defaults naming values of a level and a resolved key that may not
+# match any value
+#-------------------------------------------------------------------------------
+def generate_random_configs(rand: random.Random, tree_index: int):
+    levels = rand.sample(RESOLVABLE_LEVELS, rand.randint(1, len(RESOLVABLE_LEVELS)))
+    fan_out = rand.randint(1, 3)
+    configs = []
+    for config_index in range(rand.randint(1, 3)):
+        config = generate_config_node(rand, levels, rand.randint(1, 3), fan_out, 4, f"tree{tree_index}.config{config_index}")
+        config['defaults'] = {f"key_{i}": f"default-value-{i}" for i in range(rand.randint(0, 4))}
+        if rand.random() < 0.5:
+            level = rand.choice(levels)
+            config['defaults'][level] = f"{level}-{rand.randrange(fan_out)}"
+        config['resolved'] = {'source_config_file': f"tree-{tree_index}-config-{config_index}"}
+        configs.append(config)
+    resolved_keys = {levels[0]: f"{levels[0]}-{rand.randrange(fan_out + 1)}"}
+    return (configs, resolved_keys)
+
+
+#-------------------------------------------------------------------------------
+# check resolver on tst0 configs (when run from a checkout), on the generated
+# configs and on random config trees, returns number of mismatches
+#-------------------------------------------------------------------------------
+def run_resolver_check(rand: random.Random, config_files: list):
+    resolvable_keys = tailor.get_resolvable_keys_list([":AWS_DEFAULT:"])
+    checks = []
+    if os.path.isdir(TST0_DIR):
+        configs = tailor.read_config_files([os.path.join(TST0_DIR, config_file) for config_file in TST0_CONFIG_FILES])
+        for environment in TST0_ENVIRONMENTS:
+            for branch in TST0_BRANCHES:
+                checks.append((f"tst0 {environment} {branch}", configs, {'environment': environment, 'branch': branch, 'region': 'us-east-1'}))
+    else:
+        logger.warning(f"no tst0 configs in {TST0_DIR}, not checked")
+    configs = tailor.read_config_files(config_files)
+    for value_index in range(args.fan_out + 1):
+        checks.append((f"generated environment-{value_index}", configs, {'environment': f"environment-{value_index}"}))
+    for tree_index in range(args.check_trees):
+        (configs, resolved_keys) = generate_random_configs(rand, tree_index)
+        checks.append((f"random tree {tree_index}", configs, resolved_keys))
+    mismatches = [name for (name, configs, resolved_keys) in checks if not check_resolver(name, resolvable_keys, configs, resolved_keys)]
+    logger.info(f"resolver check: {len(checks) - len(mismatches)} of {len(checks)} config sets give the same config maps")
+    return len(mismatches)
+
+
+#-------------------------------------------------------------------------------
+# compare timings with baseline, returns list of stages slower than threshold
+# a baseline made with other benchmark args is not comparable
+#-------------------------------------------------------------------------------
+def compare_with_baseline(timings: dict, benchmark_args: dict, baseline_file: str):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    if baseline['benchmark_args'] != benchmark_args:
+        logger.error(f"ERROR: baseline {baseline_file} was made with other benchmark args: {baseline['benchmark_args']}")
+        sys.exit(1)
+    regressions = []
+    for stage in STAGES:
+        if stage not in baseline['timings']:
+            continue
+        change = timings[stage] / baseline['timings'][stage] - 1 if baseline['timings'][stage] else 0.0
+        flag = ''
+        if change > args.threshold and timings[stage] - baseline['timings'][stage] > MIN_REGRESSION_SECONDS:
+            flag = ' REGRESSION'
+            regressions.append(stage)
+        logger.info(f"{stage:32} {timings[stage] * 1000:10.1f}ms  baseline {baseline['timings'][stage] * 1000:10.1f}ms  {change:+7.1%}{flag}")
+    return regressions
+
+
+#-------------------------------------------------------------------------------
+# Run
+#-------------------------------------------------------------------------------
+if __name__ == "__main__":
+    try:
+        args = parser.parse_args()
+    except Exception:
+        parser.print_help()
+        sys.exit(traceback.print_exc())
+    logger = setup_logger(args.verbose)
+    # keep tailor.py messages out of the timings unless verbose
+    tailor.logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    benchmark_args = {name: value for (name, value) in vars(args).items()
+                      if name in ['config_files', 'levels', 'depth', 'fan_out', 'leaf_keys', 'templates', 'template_size',
+                                  'token_density', 'nesting', 'line_length', 'seed', 'jobs']}
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bench-tailor-')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        rand = random.Random(args.seed)
+        config_files = generate_config_files(rand, work_dir)
+        if args.check_resolver:
+            sys.exit(1 if run_resolver_check(rand, config_files) else 0)
+        tailor_files = generate_tailor_files(rand, work_dir)
+        logger.info(f"generated {sum(os.path.getsize(f) for f in config_files)} bytes of config files and "
+                    f"{sum(os.path.getsize(f) for f in tailor_files)} bytes of tailor files in {work_dir}")
+        timings = run_benchmark(config_files, tailor_files, work_dir)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+    regressions = []
+    if args.baseline:
+        regressions = compare_with_baseline(timings, benchmark_args, args.baseline)
+    else:
+        for stage in STAGES:
+            logger.info(f"{stage:32} {timings[stage] * 1000:10.1f}ms")
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'benchmark_args': benchmark_args, 'timings': timings}, f, indent=2)
+        logger.info(f"saved timings as baseline to {args.save_baseline}")
+    if regressions:
+        logger.error(f"ERROR: {len(regressions)} stages slower than baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+    sys.exit(0)
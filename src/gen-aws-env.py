@@ -2,6 +2,10 @@
 
 # examples:
 #   python3 gen-aws-env.py
+#   python3 gen-aws-env.py --jobs 16
+#   python3 gen-aws-env.py --endpoint-url http://localhost:5000      (e.g. a local moto server)
+#   python3 gen-aws-env.py --inventory-cache aws-inventory.json --cache-ttl 3600 --diff
+#   python3 gen-aws-env.py --inventory-cache aws-inventory.json --refresh us-east-1 eu-west-1
 
 import os
 import re
@@ -9,20 +13,30 @@ import sys
 import argparse
 import logging
 import traceback
+import concurrent.futures
+import json
+import time
 import yaml
 import boto3
+import botocore.config
 
 # get command line args
 parser = argparse.ArgumentParser()
 parser.add_argument("--scan-results-file", type=str, default="aws-cloud.yml", help="output file name (default aws-cloud.yml)", required=False)
 parser.add_argument("--verbose", default=False, help="add verbose messaging (default false)", required=False, action='store_true')
 parser.add_argument("--best-effort", default=False, help="best effort to determine public/private subnets (default false)", required=False, action='store_true')
+parser.add_argument("--jobs", type=int, default=8, help="number of aws describe calls made at the same time when scanning regions (default 8)", required=False)
+parser.add_argument("--max-attempts", type=int, default=10, help="number of attempts of each aws call, throttled calls are retried with backoff (default 10)", required=False)
+parser.add_argument("--endpoint-url", type=str, default=None, help="endpoint url for all aws clients, e.g. a local moto server (default None)", required=False)
+parser.add_argument("--inventory-cache", type=str, default=None, help="json file keeping the scan of each region and account, reused while younger than --cache-ttl (default no cache)", required=False)
+parser.add_argument("--cache-ttl", type=int, default=86400, help="seconds a cached scan of a region or account is reused (default 86400)", required=False)
+parser.add_argument("--refresh", nargs='*', default=None, help="list of regions to scan again even if cached scan is not stale, all regions and the account when no region is given (default None)", required=False)
+parser.add_argument("--diff", default=False, help="report vpcs, subnets and nat gateways changed since the scan in --scan-results-file (default false)", required=False, action='store_true')
 
-try:
-    args = parser.parse_args()
-except Exception:
-    parser.print_help()
-    sys.exit(traceback.print_exc())
+# globals
+INVENTORY_CACHE_VERSION = 1
+# set up again when run as a script, default for use as a module
+logger = logging.getLogger(os.path.basename(__file__))
 
 #-------------------------------------------------------------------------------
 # Set up logger
@@ -48,157 +62,358 @@ def print_config_map(resolved_paramers_filename, config_map):
 
 
 #-------------------------------------------------------------------------------
-# get account information
+# create client of aws service, failed and throttled calls are retried with
+# exponential backoff, in adaptive mode the client also slows down its calls
+# after being throttled
 #-------------------------------------------------------------------------------
-def get_aws_account_info():
-    account_id = boto3.client('sts').get_caller_identity()["Account"]
+def get_aws_client(session: boto3.session.Session, service: str, region: str = None, max_attempts: int = 10, jobs: int = 8, endpoint_url: str = None):
+    config = botocore.config.Config(retries={'max_attempts': max_attempts, 'mode': 'adaptive'}, max_pool_connections=max(jobs, 10))
+    return session.client(service, region_name=region, endpoint_url=endpoint_url, config=config)
+
+
+#-------------------------------------------------------------------------------
+# get account id
+#-------------------------------------------------------------------------------
+def get_aws_account_id(client: boto3.client):
+    return client.get_caller_identity()["Account"]
+
+
+#-------------------------------------------------------------------------------
+# get account name, the first account alias or else the account id
+#-------------------------------------------------------------------------------
+def get_aws_account_name(client: boto3.client, account_id: str):
     account_name = account_id
-    for account_alias in boto3.client('iam').list_account_aliases()['AccountAliases']:
+    for account_alias in client.list_account_aliases()['AccountAliases']:
         account_name = account_alias
         break
-    return(account_name, account_id)
+    return account_name
 
 
 #-------------------------------------------------------------------------------
 # get list of all usable regions
 #-------------------------------------------------------------------------------
-def get_aws_regions():
+def get_aws_regions(client: boto3.client):
     try:
-        response = boto3.client('ec2').describe_regions()
+        response = client.describe_regions()
         regions = [r["RegionName"] for r in response["Regions"]]
     except Exception:
         logger.error("Could not get regions")
-        sys.exit(traceback.print_exc())
+        traceback.print_exc()
+        sys.exit(1)
     return regions
 
 
 #-------------------------------------------------------------------------------
-# get list of all vpcs in region
+# get all items of a describe call, following every page of results
+#-------------------------------------------------------------------------------
+def get_all_pages(client: boto3.client, operation: str, result_key: str):
+    return [item for page in client.get_paginator(operation).paginate() for item in page[result_key]]
+
+
+#-------------------------------------------------------------------------------
+# group items of describe call by vpc, e.g. {'vpc-1': [subnet, ...]}
+#-------------------------------------------------------------------------------
+def group_by_vpc(items: list):
+    items_by_vpc = {}
+    for item in items:
+        items_by_vpc.setdefault(item['VpcId'], []).append(item)
+    return items_by_vpc
+
+
+#-------------------------------------------------------------------------------
+# get list of all vpcs in region, None if they could not be listed
 #-------------------------------------------------------------------------------
 def get_vpcs(client: boto3.client, region: str):
     try:
-        response = client.describe_vpcs()
-        vpcs = [v["VpcId"] for v in response["Vpcs"]]
+        vpcs = get_all_pages(client, 'describe_vpcs', 'Vpcs')
     except Exception:
         logger.error(f"could not get vpcs in region {region}")
         logger.debug(traceback.print_exc())
-        vpcs = []
+        vpcs = None
     return vpcs
 
 
 #-------------------------------------------------------------------------------
-# get list of all vpcs in region
+# get all subnets in region by vpc, None if they could not be listed
 #-------------------------------------------------------------------------------
-def get_vpc_subnets(client: boto3.client, vpc: str, region: str):
+def get_region_subnets(client: boto3.client, region: str):
+    try:
+        subnets = group_by_vpc(get_all_pages(client, 'describe_subnets', 'Subnets'))
+    except Exception:
+        logger.error(f"could not get subnets in region {region}")
+        logger.debug(traceback.print_exc())
+        subnets = None
+    return subnets
+
+
+#-------------------------------------------------------------------------------
+# get all nat gateways in region by vpc, None if they could not be listed
+#-------------------------------------------------------------------------------
+def get_region_nat_gateways(client: boto3.client, region: str):
+    try:
+        nat_gateways = group_by_vpc(get_all_pages(client, 'describe_nat_gateways', 'NatGateways'))
+    except Exception:
+        logger.error(f"could not get nat gateways in region {region}")
+        logger.debug(traceback.print_exc())
+        nat_gateways = None
+    return nat_gateways
+
+
+#-------------------------------------------------------------------------------
+# get subnets of vpc
+#-------------------------------------------------------------------------------
+def get_vpc_subnets(vpc_subnets: list, best_effort: bool = False):
     subnets = []
     public_subnets = []
     private_subnets = []
-    try:
-        response = client.describe_subnets(Filters=[{'Name': 'vpc-id','Values': [vpc]}])
-        for subnet in response["Subnets"]:
-            subnet_name = ''
-            subnet_id = subnet['SubnetId']
-            if 'Tags' in subnet:
-                for tag in subnet['Tags']:
-                    if tag['Key'] == 'Name':
-                        subnet_name = tag['Value']
-                        if args.best_effort:
-                            # if subnet tag value has the substring public in it, assume it is a public subnet and add to public_subnet list
-                            if 'public' in tag['Value'].lower():
-                                public_subnets.append(subnet_id)
-                            if 'private' in tag['Value'].lower():
-                                private_subnets.append(subnet_id)
-                        break
-            subnets.append({subnet_id: {'subnet_name': subnet_name, 'cidr': subnet['CidrBlock'], 'az': subnet['AvailabilityZone']}})
-    except Exception:
-        logger.error(f"could not get vpcs in region {region}")
-        sys.exit(traceback.print_exc())
+    for subnet in vpc_subnets:
+        subnet_name = ''
+        subnet_id = subnet['SubnetId']
+        if 'Tags' in subnet:
+            for tag in subnet['Tags']:
+                if tag['Key'] == 'Name':
+                    subnet_name = tag['Value']
+                    if best_effort:
+                        # if subnet tag value has the substring public in it, assume it is a public subnet and add to public_subnet list
+                        if 'public' in tag['Value'].lower():
+                            public_subnets.append(subnet_id)
+                        if 'private' in tag['Value'].lower():
+                            private_subnets.append(subnet_id)
+                    break
+        subnets.append({subnet_id: {'subnet_name': subnet_name, 'cidr': subnet['CidrBlock'], 'az': subnet['AvailabilityZone']}})
     return (subnets, private_subnets, public_subnets)
 
 
 #-------------------------------------------------------------------------------
 # get list of nat gateway ip addresses
 #-------------------------------------------------------------------------------
-def get_nat_gateway_ips(client: boto3.client, vpc: str, region: str):
-    nat_gateway_ips = []
-    try:
-        response = client.describe_nat_gateways(Filters=[{'Name': 'vpc-id','Values': [vpc]}])
-        nat_gateway_ips = [n["NatGatewayAddresses"][0]['PublicIp'] for n in response["NatGateways"]]
-    except Exception:
-        logger.error(f"could not get nat gateways for vpc {vpc} in region {region}")
-        sys.exit(traceback.print_exc())
-    return nat_gateway_ips
+def get_nat_gateway_ips(vpc_nat_gateways: list):
+    return [n["NatGatewayAddresses"][0]['PublicIp'] for n in vpc_nat_gateways]
 
 
 #-------------------------------------------------------------------------------
-# get list of all vpcs in region
+# get vpc information from its description, subnets and nat gateways
 #-------------------------------------------------------------------------------
-def get_vpc_info(client: boto3.client, vpc: str, region: str):
+def get_vpc_info(vpc: dict, vpc_subnets: list, vpc_nat_gateways: list, region: str, best_effort: bool = False):
     vpc_info = { 'defaults': {}, 'subnet': []}
     try:
-        response = client.describe_vpcs(VpcIds=[vpc])
-        vpc_info['defaults']['vpc_cidrs'] = ','.join([c["CidrBlock"] for c in response['Vpcs'][0]["CidrBlockAssociationSet"]])
-        vpc_info['defaults']['is_default'] = response['Vpcs'][0]['IsDefault']
+        vpc_info['defaults']['vpc_cidrs'] = ','.join([c["CidrBlock"] for c in vpc["CidrBlockAssociationSet"]])
+        vpc_info['defaults']['is_default'] = vpc['IsDefault']
         vpc_info['defaults']['vpc_name'] = ''
-        if 'Tags' in response['Vpcs'][0]:
-            for tag in response['Vpcs'][0]['Tags']:
+        if 'Tags' in vpc:
+            for tag in vpc['Tags']:
                 if tag['Key'] == 'Name':
                     vpc_info['defaults']['vpc_name'] = tag['Value']
                     break
-        (subnets, private_subnets, public_subnets) = get_vpc_subnets(client, vpc, region)
-        nat_gw_ips = get_nat_gateway_ips(client, vpc, region)
+        (subnets, private_subnets, public_subnets) = get_vpc_subnets(vpc_subnets, best_effort)
+        nat_gw_ips = get_nat_gateway_ips(vpc_nat_gateways)
         vpc_info['subnet'] = subnets
-        if args.best_effort:
+        if best_effort:
             if private_subnets:
                 vpc_info['defaults']['private_subnets'] = ','.join(private_subnets)
             if public_subnets:
                 vpc_info['defaults']['public_subnets'] = ','.join(public_subnets)
         vpc_info['defaults']['nat_gw'] = ','.join(nat_gw_ips)
-        vpc_info['defaults']['nat_gw'] = ','.join(nat_gw_ips)
     except Exception:
-        logger.error(f"could not get vpc information for {vpc} in region {region}")
-        sys.exit(traceback.print_exc())
+        logger.error(f"could not get vpc information for {vpc['VpcId']} in region {region}")
+        traceback.print_exc()
+        sys.exit(1)
     return vpc_info
 
 
 #-------------------------------------------------------------------------------
 # scan vpc information in each region and create map
+# each region is scanned with one paginated describe call each of vpcs, subnets
+# and nat gateways, grouped by vpc afterwards.  calls are made by a pool of
+# threads, the map is put together in order of regions and vpcs afterwards, so
+# output does not depend on which call finishes first.  a session can be
+# passed in, e.g. with clients stubbed by botocore's Stubber
+#-------------------------------------------------------------------------------
+# with an inventory cache, the account and regions scanned less than cache_ttl
+# seconds ago are taken from the cache instead.  only regions scanned successfully are
+# cached, a region whose vpcs, subnets or nat gateways could not be listed is
+# scanned again next run and until then its earlier cached scan, if any, is used
 #-------------------------------------------------------------------------------
-def map_aws_cloud_environment():
-    (account_name, account_id) = get_aws_account_info()
+def map_aws_cloud_environment(session: boto3.session.Session = None, jobs: int = 8, max_attempts: int = 10, endpoint_url: str = None, best_effort: bool = False,
+                              inventory_cache: str = None, cache_ttl: int = 86400, refresh: list = None):
+    if session is None:
+        session = boto3.session.Session()
+    client_settings = {'max_attempts': max_attempts, 'jobs': jobs, 'endpoint_url': endpoint_url}
+    scan_settings = {'refresh': refresh, 'best_effort': best_effort, 'cache_ttl': cache_ttl}
+    inventory = read_inventory_cache(inventory_cache)
+    account_id = get_aws_account_id(get_aws_client(session, 'sts', **client_settings))
+    account_inventory = inventory.setdefault(account_id, {'account': None, 'regions': {}})
+    if not is_fresh_scan(account_inventory['account'], **scan_settings):
+        account_inventory['account'] = {'scanned_at': time.time(),
+                                        'account_name': get_aws_account_name(get_aws_client(session, 'iam', **client_settings), account_id),
+                                        'regions': get_aws_regions(get_aws_client(session, 'ec2', **client_settings))}
+    (account_name, regions) = (account_inventory['account']['account_name'], account_inventory['account']['regions'])
     account_info = {account_name: {'defaults': {'account_id': account_id}, 'region': {}}}
-    regions = get_aws_regions()
+    region_inventory = account_inventory['regions']
+    scan_regions = [region for region in regions if not is_fresh_scan(region_inventory.get(region), region, **scan_settings)]
+    if inventory_cache:
+        logger.info(f"scanning {len(scan_regions)} of {len(regions)} regions, others taken from {inventory_cache}")
+    # one client per region, created up front as creating clients is not thread safe
+    ec2_clients = {region: get_aws_client(session, 'ec2', region, **client_settings) for region in scan_regions}
 
-    logger.debug(f"scanning regions: {regions}")
-    for region in regions:
-        account_info[account_name]['region'][region] = {'vpc': {}}
-        account_info_vpc = account_info[account_name]['region'][region]['vpc']
-        try:
-            ec2_client = boto3.client('ec2', region_name=region)
-            vpcs = get_vpcs(ec2_client, region)
+    logger.debug(f"scanning regions: {scan_regions} using {jobs} threads")
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    failed_regions = []
+    try:
+        region_futures = {region: [executor.submit(get_region_items, ec2_clients[region], region)
+                                   for get_region_items in [get_vpcs, get_region_subnets, get_region_nat_gateways]]
+                          for region in scan_regions}
+        for region in scan_regions:
+            (vpcs, subnets, nat_gateways) = [future.result() for future in region_futures[region]]
+            if vpcs is None or subnets is None or nat_gateways is None:
+                failed_regions.append(region)
+                continue
+            account_info_vpc = {}
             for vpc in vpcs:
-                vpc_info = get_vpc_info(ec2_client, vpc, region)
-                account_info_vpc[vpc] = vpc_info
-                # if vpc_info is empty, remove vpc from account_info_vpc
-                if not account_info_vpc[vpc]:
-                    del account_info_vpc[vpc]
-        except Exception:
-            logger.error("could not get regions")
-            sys.exit(traceback.print_exc())
-        finally:
-            # if region does not have any vpcs, remove region from account_info
-            if not account_info_vpc:
-                del account_info[account_name]['region'][region]
+                vpc_info = get_vpc_info(vpc, subnets.get(vpc['VpcId'], []), nat_gateways.get(vpc['VpcId'], []), region, best_effort)
+                # if vpc_info is empty, leave out vpc
+                if vpc_info:
+                    account_info_vpc[vpc['VpcId']] = vpc_info
+            region_inventory[region] = {'scanned_at': time.time(), 'best_effort': best_effort, 'vpc': account_info_vpc}
+    finally:
+        # on first failed call, cancel all calls not yet started
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    if failed_regions:
+        logger.error(f"could not scan region(s) {', '.join(failed_regions)}, using earlier cached scans where there are any")
+    for region in regions:
+        # if region does not have any vpcs (or no scan), leave out region
+        if region in region_inventory and region_inventory[region]['vpc']:
+            account_info[account_name]['region'][region] = {'vpc': region_inventory[region]['vpc']}
+    write_inventory_cache(inventory_cache, inventory)
 
     print(f"{yaml.dump(account_info)}")
     return account_info
 
 
+#-------------------------------------------------------------------------------
+# check if cached scan of an account (region None) or region can be reused,
+# i.e. it is younger than cache_ttl seconds, not named by refresh (all regions
+# and the account when refresh is empty) and, for a region, made with the same
+# best_effort
+#-------------------------------------------------------------------------------
+def is_fresh_scan(scan: dict, region: str = None, refresh: list = None, best_effort: bool = False, cache_ttl: int = 86400):
+    if scan is None:
+        return False
+    if refresh is not None and (not refresh or region in refresh):
+        return False
+    if region is not None and scan['best_effort'] != best_effort:
+        return False
+    return time.time() - scan['scanned_at'] < cache_ttl
+
+
+#-------------------------------------------------------------------------------
+# read scanned accounts and regions from inventory cache, a missing, unreadable
+# or older version of the cache is empty
+#-------------------------------------------------------------------------------
+def read_inventory_cache(inventory_cache_file_name: str):
+    if not inventory_cache_file_name or not os.path.isfile(inventory_cache_file_name):
+        return {}
+    try:
+        with open(inventory_cache_file_name) as f:
+            inventory_cache = json.load(f)
+        if inventory_cache['version'] == INVENTORY_CACHE_VERSION:
+            return inventory_cache['accounts']
+        logger.info(f"inventory cache {inventory_cache_file_name} is of an older version, scanning all regions")
+    except Exception:
+        logger.warning(f"Could not read inventory cache {inventory_cache_file_name}, scanning all regions")
+    return {}
+
+
+#-------------------------------------------------------------------------------
+# write scanned accounts and regions to inventory cache
+#-------------------------------------------------------------------------------
+def write_inventory_cache(inventory_cache_file_name: str, inventory: dict):
+    if not inventory_cache_file_name:
+        return
+    logger.debug(f"writing inventory cache to {inventory_cache_file_name}")
+    with open(inventory_cache_file_name, 'w') as f:
+        json.dump({'version': INVENTORY_CACHE_VERSION, 'accounts': inventory}, f, indent=1, sort_keys=True)
+
+
+#-------------------------------------------------------------------------------
+# read accounts of earlier scan results file, empty if there is none
+#-------------------------------------------------------------------------------
+def read_scan_results(scan_results_file_name: str):
+    if not os.path.isfile(scan_results_file_name):
+        logger.info(f"no earlier scan results in {scan_results_file_name} to compare with")
+        return {}
+    with open(scan_results_file_name) as f:
+        return ((yaml.safe_load(f) or {}).get('config') or {}).get('account_name') or {}
+
+
+#-------------------------------------------------------------------------------
+# list vpcs, subnets and nat gateways added, removed or changed between two
+# scans, e.g. ['subnet subnet-1 of vpc my-account/us-east-1/vpc-1 added']
+#-------------------------------------------------------------------------------
+def get_scan_changes(old_accounts: dict, new_accounts: dict):
+    changes = []
+    for account_name in sorted(old_accounts.keys() | new_accounts.keys()):
+        old_regions = old_accounts.get(account_name, {}).get('region') or {}
+        new_regions = new_accounts.get(account_name, {}).get('region') or {}
+        for region in sorted(old_regions.keys() | new_regions.keys()):
+            old_vpcs = old_regions.get(region, {}).get('vpc') or {}
+            new_vpcs = new_regions.get(region, {}).get('vpc') or {}
+            for vpc in sorted(old_vpcs.keys() | new_vpcs.keys()):
+                vpc_path = f"{account_name}/{region}/{vpc}"
+                if vpc not in old_vpcs:
+                    changes.append(f"vpc {vpc_path} added")
+                elif vpc not in new_vpcs:
+                    changes.append(f"vpc {vpc_path} removed")
+                else:
+                    changes += get_vpc_changes(vpc_path, old_vpcs[vpc], new_vpcs[vpc])
+    return changes
+
+
+#-------------------------------------------------------------------------------
+# list changes of a vpc in both scans
+#-------------------------------------------------------------------------------
+def get_vpc_changes(vpc_path: str, old_vpc: dict, new_vpc: dict):
+    changes = []
+    (old_defaults, new_defaults) = (old_vpc.get('defaults') or {}, new_vpc.get('defaults') or {})
+    for key in sorted((old_defaults.keys() | new_defaults.keys()) - {'nat_gw'}):
+        if old_defaults.get(key) != new_defaults.get(key):
+            changes.append(f"vpc {vpc_path} {key} changed from {old_defaults.get(key)!r} to {new_defaults.get(key)!r}")
+
+    (old_ips, new_ips) = [set(filter(None, str(defaults.get('nat_gw', '')).split(','))) for defaults in [old_defaults, new_defaults]]
+    changes += [f"nat gateway {ip} of vpc {vpc_path} added" for ip in sorted(new_ips - old_ips)]
+    changes += [f"nat gateway {ip} of vpc {vpc_path} removed" for ip in sorted(old_ips - new_ips)]
+
+    (old_subnets, new_subnets) = [{subnet_id: subnet_info for subnet in vpc.get('subnet') or [] for (subnet_id, subnet_info) in subnet.items()} for vpc in [old_vpc, new_vpc]]
+    for subnet_id in sorted(old_subnets.keys() | new_subnets.keys()):
+        if subnet_id not in old_subnets:
+            changes.append(f"subnet {subnet_id} of vpc {vpc_path} added")
+        elif subnet_id not in new_subnets:
+            changes.append(f"subnet {subnet_id} of vpc {vpc_path} removed")
+        elif old_subnets[subnet_id] != new_subnets[subnet_id]:
+            changes.append(f"subnet {subnet_id} of vpc {vpc_path} changed")
+    return changes
+
+
 #-------------------------------------------------------------------------------
 # Run
 #-------------------------------------------------------------------------------
 if __name__ == "__main__":
+    try:
+        args = parser.parse_args()
+    except Exception:
+        parser.print_help()
+        traceback.print_exc()
+        sys.exit(1)
     logger = setup_logger(args.verbose)
-    aws_cloud_environment = map_aws_cloud_environment()
+    if args.diff:
+        scanned_accounts = read_scan_results(args.scan_results_file)
+    aws_cloud_environment = map_aws_cloud_environment(jobs=args.jobs, max_attempts=args.max_attempts, endpoint_url=args.endpoint_url, best_effort=args.best_effort,
+                                                      inventory_cache=args.inventory_cache, cache_ttl=args.cache_ttl, refresh=args.refresh)
+    if args.diff:
+        scan_changes = get_scan_changes(scanned_accounts, aws_cloud_environment)
+        for scan_change in scan_changes:
+            logger.info(f"changed: {scan_change}")
+        logger.info(f"{len(scan_changes)} change(s) since scan in {args.scan_results_file}")
     print_config_map(args.scan_results_file, aws_cloud_environment)
     sys.exit(0)
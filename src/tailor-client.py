@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+# thin client for a running 'tailor.py --serve <socket>', takes the same args as tailor.py
+# examples:
+#   python3 tailor.py --serve /tmp/tailor.sock &
+#   TAILOR_SOCKET=/tmp/tailor.sock python3 tailor-client.py --config-files tst0/config-first.yml tst0/config-second.yml tst0/config-third.yml --defaults environment=prod branch=hotfix region=us-east-1 --tailor-files 'tst0/tailor-template/tst0*'
+# when TAILOR_SOCKET is not set or no server is listening on it, tailor.py is run instead
+
+import os
+import sys
+import json
+import socket
+
+
+#-------------------------------------------------------------------------------
+# send args and working directory to server, write output sent back and
+# return exit code
+#-------------------------------------------------------------------------------
+def request_tailor(socket_path: str, tailor_args: list):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    with client, client.makefile('rwb') as f:
+        f.write((json.dumps({'cwd': os.getcwd(), 'args': tailor_args}) + '\n').encode())
+        f.flush()
+        for line in f:
+            response = json.loads(line)
+            if 'exit' in response:
+                return response['exit']
+            if 'stdout' in response:
+                sys.stdout.write(response['stdout'])
+            if 'stderr' in response:
+                sys.stderr.write(response['stderr'])
+    sys.stderr.write(f"ERROR: connection to {socket_path} closed before request finished\n")
+    return 1
+
+
+#-------------------------------------------------------------------------------
+# Run
+#-------------------------------------------------------------------------------
+if __name__ == "__main__":
+    socket_path = os.environ.get('TAILOR_SOCKET')
+    if socket_path:
+        try:
+            sys.exit(request_tailor(socket_path, sys.argv[1:]))
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+    tailor_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tailor.py')
+    os.execv(sys.executable, [sys.executable, tailor_script] + sys.argv[1:])
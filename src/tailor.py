@@ -8,34 +8,102 @@ import sys
 import argparse
 import logging
 import glob
+import fnmatch
 import re
 import traceback
-import copy
 import tempfile
 import shutil
+import stat
+import logging.handlers
+import concurrent.futures
+import hashlib
+import functools
+import json
+import codecs
+import locale
+import pickle
+import socket
+import socketserver
+import contextlib
+import signal
+import time
+import resource
+import io
+import difflib
+import filecmp
 import yaml
 
 # get command line args
 parser = argparse.ArgumentParser()
-parser.add_argument("--config-files", nargs='+', default=[], help="list of configuration files in order of precedence", required=True)
-parser.add_argument("--tailor-files", nargs='+', default=[], help="List of glob patterns to use for searching files to tailor (default None)", required=False)
+parser.add_argument("--config-files", nargs='+', default=[], help="list of configuration files or http(s) urls in order of precedence (required unless --serve)", required=False)
+parser.add_argument("--tailor-files", nargs='+', default=[], help="List of glob patterns to use for searching files to tailor, ** matches any number of directories (default None)", required=False)
+parser.add_argument("--exclude-files", nargs='*', default=[], help="list of glob patterns of files and directories not to tailor, added to patterns in .tailorignore (e.g. '**/node_modules') (default None)", required=False)
 parser.add_argument("--defaults", nargs='*', default=[], help="list of key value pairs (default None)", required=False)
 parser.add_argument("--resolve-keys", nargs='*', default=[":AWS_DEFAULT:"], help="list of key names to resolve in config files (default :AWS_DEFAULT:)", required=False)
 parser.add_argument("--ignore-keys", nargs='*', default=[], help="list of key names to always ignore in tailored files", required=False)
-parser.add_argument("--resolved-file", type=str, default="tailor.yml", help="output file name ", required=False)
+parser.add_argument("--resolved-file", type=str, default="tailor.yml", help="output file name, written as json for .json and else yaml, .pickle is not allowed (default tailor.yml)", required=False)
+parser.add_argument("--from-resolved", type=str, default=None, help="resolved file of an earlier run (yaml or .json) to tailor with, instead of parsing and resolving --config-files, --resolved-file is not written (default None)", required=False)
+parser.add_argument("--matrix", nargs='+', default=[], help="list of comma separated key=value sets (e.g. environment=dev,region=us-east-1), each added to --defaults and resolved and tailored in to its own directory (default None)", required=False)
+parser.add_argument("--matrix-dir", type=str, default="tailor-matrix", help="directory for each --matrix set, either a parent directory or a pattern using {key} names of the set (default tailor-matrix)", required=False)
+parser.add_argument("--output-dir", type=str, default=None, help="directory to write tailored files to at the same path as in the current directory, instead of next to their tailor files (default None)", required=False)
+parser.add_argument("--dry-run", dest='output_mode', default='write', const='dry-run', help="tailor files in memory only, without writing tailored files, resolved file or manifest (default false)", required=False, action='store_const')
+parser.add_argument("--diff", dest='output_mode', default='write', const='diff', help="as --dry-run, and print differences between existing and tailored files (default false)", required=False, action='store_const')
+parser.add_argument("--jobs", type=int, default=1, help="number of processes used to tailor files, 0 for one per cpu (default 1)", required=False)
+parser.add_argument("--incremental", default=False, help="skip tailor files whose template and referenced keys did not change since the last run (default false)", required=False, action='store_true')
+parser.add_argument("--cache-dir", type=str, default=None, help="directory to cache parsed config files in, only used when owned by the current user and not writable by group or others (default no cache)", required=False)
+parser.add_argument("--url-cache-dir", type=str, default=".tailor-url-cache", help="directory to keep config files fetched from urls in, revalidated on each fetch and used when a url can not be fetched for network or server (5xx) errors (default .tailor-url-cache)", required=False)
+parser.add_argument("--url-timeout", type=float, default=30, help="seconds to wait for a config file url before using its cached copy (default 30)", required=False)
+parser.add_argument("--clear-cache", default=False, help="remove all cached config files from --cache-dir before parsing (default false)", required=False, action='store_true')
+parser.add_argument("--referenced-only", default=False, help="only consolidate keys referenced by tailor files (and keys nested in their values), writing only those to --resolved-file and checking all tokens before writing any file (default false)", required=False, action='store_true')
+parser.add_argument("--profile", type=str, default=None, help="write json report of time spent in each phase and per tailor file to this file (default None)", required=False)
+parser.add_argument("--serve", type=str, default=None, help="serve requests of tailor-client.py on this unix socket, keeping parsed configs and resolved keys in memory (default None)", required=False)
 parser.add_argument("--verbose", default=False, help="add verbose messaging (default false)", required=False, action='store_true')
 
-try:
-    args = parser.parse_args()
-except Exception:
-    parser.print_help()
-    sys.exit(traceback.print_exc())
-
 # globals
 PRESET_RESOLVE_KEYS = {
     "AWS_DEFAULT": ['environment', 'branch', 'account_name', 'region', 'vpc'],
     "AZURE_DEFAULT": ['environment', 'branch', 'subscription_name', 'region', 'vnet']
 }
+# use libyaml parser if PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, 'CDumper', yaml.Dumper)
+# formats of resolved file by extension, any other is yaml
+RESOLVED_FILE_FORMATS = {'.json': 'json'}
+CONFIG_CACHE_VERSION = 1
+CONFIG_URL_PATTERN = re.compile(r'https?://', re.IGNORECASE)
+URL_CACHE_DIR = '.tailor-url-cache'
+URL_CACHE_VERSION = 1
+URL_TIMEOUT = 30
+MAX_URL_FETCHES = 8
+TOKEN_PATTERN = re.compile(r'\{\{\s*([\w\.]+?)\s*\}\}')
+IGNORED_TOKEN_PATTERN = re.compile(r'\{\%([\w\.]+?)\%\}')
+# long lines are cut after the last character that can not be part of a token, or
+# failing that, before text at the end of a chunk that may be the start of a token
+SAFE_CUT_PATTERN = re.compile(r'(?<=[^{}%\w\.\s])[{}%\w\.\s]*$')
+PARTIAL_TOKEN_PATTERN = re.compile(r'\{(?:\{\s*[\w\.]*\s*\}?|\%[\w\.]*\%?)?$')
+CHUNK_SIZE = 1024 * 1024
+MAGIC_PATTERN = re.compile(r'[*?[]')
+TAILOR_IGNORE_FILE = '.tailorignore'
+CUT_SEARCH_SIZE = 4096
+BINARY_CHECK_SIZE = 8192
+LOGGER_FORMAT = '%(asctime)s - %(name)s - [%(levelname)s] - %(message)s'
+# with --serve, parsed configs and resolved keys kept between requests
+served_configs = None
+served_config_maps = None
+SERVED_CONFIG_MAPS_SIZE = 64
+# with --profile, times and counts of the current run
+PROFILE_VERSION = 1
+profile = None
+# set up again when run as a script, default for use as a module
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+#-------------------------------------------------------------------------------
+# error for configs, defaults or tailor files that can not be resolved or
+# tailored, reported with its message and exit code 1 when run as a script
+#-------------------------------------------------------------------------------
+class TailorError(Exception):
+    pass
 
 #-------------------------------------------------------------------------------
 # get ordered list of keys form list matching keyword
@@ -44,8 +112,7 @@ def get_preset_list(preset_list_name):
     if preset_list_name in PRESET_RESOLVE_KEYS:
         logger.debug(f"Using preset ordered list '{preset_list_name}': {PRESET_RESOLVE_KEYS[preset_list_name]}")
         return PRESET_RESOLVE_KEYS[preset_list_name]
-    logger.error(f"No preset ordered key list exists for '{preset_list_name}'")
-    sys.exit(1)
+    raise TailorError(f"No preset ordered key list exists for '{preset_list_name}'")
 
 
 #-------------------------------------------------------------------------------
@@ -70,9 +137,8 @@ def parse_defaults(defaults: list):
             logger.debug(f"SET: {item[0]}={item[1]}")
             lookup_defaults[item[0]] = item[1]
         return lookup_defaults
-    except Exception:
-        logger.error(f"could net evaluate {defaults}")
-        sys.exit(traceback.print_exc())
+    except Exception as e:
+        raise TailorError(f"could not evaluate {defaults}, expected key=value pairs") from e
 
 
 #-------------------------------------------------------------------------------
@@ -82,8 +148,7 @@ def setup_logger(verbose):
     log_level = logging.INFO
     if verbose:
         log_level = logging.DEBUG
-    logger_format = '%(asctime)s - %(name)s - [%(levelname)s] - %(message)s'
-    logging.basicConfig(format=logger_format, level=log_level)
+    logging.basicConfig(format=LOGGER_FORMAT, level=log_level)
     return logging.getLogger(os.path.basename(__file__))
 
 
@@ -94,149 +159,677 @@ def get_config_files(config_files: list):
     config_files_list = []
     for config_file in config_files:
         if not os.path.isfile(config_file):
-            logger.error(f"Config file, {config_file}, does not exist or is not a regular file")
-            sys.exit(1)
+            raise TailorError(f"Config file, {config_file}, does not exist or is not a regular file")
         config_files_list.append(config_file)
     return config_files_list
 
 
 #-------------------------------------------------------------------------------
 # get list of files to be tailored
+# all patterns are matched in a single walk of the directories below their
+# fixed leading directories, not entering directories no pattern can match or
+# an exclude pattern matches.  files are listed once, in order of the first
+# pattern matching them, then by path
 #-------------------------------------------------------------------------------
-def get_tailor_files(tailor_files: list):
+def get_tailor_files(tailor_files: list, exclude_files: list = None):
+    includes = [compile_file_pattern(tailor_file_glob) for tailor_file_glob in tailor_files]
+    excludes = [compile_file_pattern(exclude_file_glob) for exclude_file_glob in list(exclude_files or []) + read_tailor_ignore_file(TAILOR_IGNORE_FILE)]
+    matches = {}
+    matched_indexes = set()
+    for (path, indexes) in walk_file_patterns(includes, excludes):
+        index = min(indexes)
+        # same file can be matched by different patterns, e.g. 'a/*' and './a/*'
+        matches.setdefault(path, (index, path, os.path.join(includes[index][0], *path[len(includes[index][1]):])))
+        matched_indexes.update(indexes)
+
     tailor_files_list = []
-    for tailor_file_glob in tailor_files:
-        tailor_file_matches = glob.glob(tailor_file_glob)
-        if not tailor_file_matches:
+    for (_, _, tailor_file_name) in sorted(matches.values()):
+        tailor_files_list.append(tailor_file_name)
+    for (index, tailor_file_glob) in enumerate(tailor_files):
+        if index not in matched_indexes:
             logger.warning(f"Tailor file pattern, {tailor_file_glob}, does not match any files")
-        for tailor_file_match in tailor_file_matches:
-            tailor_files_list.append(tailor_file_match)
     return tailor_files_list
 
 
+#-------------------------------------------------------------------------------
+# read patterns of .tailorignore in the current directory, one per line,
+# blank lines and lines starting with # are skipped
+#-------------------------------------------------------------------------------
+def read_tailor_ignore_file(tailor_ignore_file_name: str):
+    if not os.path.isfile(tailor_ignore_file_name):
+        return []
+    with open(tailor_ignore_file_name) as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+#-------------------------------------------------------------------------------
+# split glob pattern in to (fixed leading directories as given, the same as
+# absolute path components, tuple of remaining components), each remaining
+# component is '**', a name, or a compiled pattern of a name
+# e.g. in /src 'tst0/*/tst*.yml' -> ('tst0', ('', 'src', 'tst0'), [<*>, <tst*.yml>])
+# '.' and '..' are only allowed in the fixed leading directories, names read
+# from a directory never are '.' or '..', so after a wildcard they would
+# silently match nothing
+#-------------------------------------------------------------------------------
+def compile_file_pattern(file_glob: str):
+    components = file_glob.split('/')
+    fixed = 0
+    while fixed < len(components) - 1 and not MAGIC_PATTERN.search(components[fixed]):
+        fixed += 1
+    root = '/'.join(components[:fixed]) or ('/' if file_glob.startswith('/') else '')
+    root_path = tuple(os.path.abspath(root or '.').split('/'))
+    if root_path == ('', ''):
+        root_path = ('',)
+    pattern = []
+    for component in components[fixed:]:
+        if component in ('.', '..') and MAGIC_PATTERN.search(components[fixed]):
+            raise TailorError(f"ERROR: file pattern {file_glob} has '{component}' after a wildcard, only the directories before the first wildcard can use '{component}'")
+        if component == '**' or not MAGIC_PATTERN.search(component):
+            pattern.append(component)
+        elif component.startswith('.'):
+            pattern.append(re.compile(fnmatch.translate(component)))
+        else:
+            # as with glob, names starting with '.' are only matched by a pattern starting with '.'
+            pattern.append(re.compile(r'(?!\.)' + fnmatch.translate(component)))
+    return (root, root_path, tuple(component for component in pattern if component != ''))
+
+
+#-------------------------------------------------------------------------------
+# positions in pattern components that can match the next name of a path, for
+# the directory a pattern starts at
+#-------------------------------------------------------------------------------
+def get_start_positions(pattern: tuple):
+    return add_double_star_positions(pattern, {0})
+
+
+#-------------------------------------------------------------------------------
+# positions after matching name, a position of len(pattern) means the path up
+# to and including name matches the whole pattern, e.g. for ['**', <*.tf>]
+# {0, 1} -> 'main.tf' -> {0, 1, 2}
+#-------------------------------------------------------------------------------
+def advance_pattern_positions(pattern: tuple, positions: frozenset, name: str):
+    next_positions = set()
+    for position in positions:
+        if position == len(pattern):
+            continue
+        component = pattern[position]
+        if component == '**':
+            # as with glob, ** does not match names starting with '.'
+            if not name.startswith('.'):
+                next_positions.add(position)
+        elif component == name if isinstance(component, str) else component.match(name):
+            next_positions.add(position + 1)
+    return add_double_star_positions(pattern, next_positions)
+
+
+#-------------------------------------------------------------------------------
+# '**' also matches no names, so the position after it can match as well
+#-------------------------------------------------------------------------------
+def add_double_star_positions(pattern: tuple, positions: set):
+    for position in list(positions):
+        while position < len(pattern) and pattern[position] == '**':
+            position += 1
+            positions.add(position)
+    return frozenset(positions)
+
+
+#-------------------------------------------------------------------------------
+# positions in each pattern for a directory, as tuple of (index of pattern,
+# positions), leaving out patterns not starting at or above it, or no longer
+# matching
+#-------------------------------------------------------------------------------
+def get_pattern_positions(file_patterns: list, path: tuple):
+    pattern_positions = []
+    for (index, (_, root_path, pattern)) in enumerate(file_patterns):
+        if path[:len(root_path)] != root_path:
+            continue
+        positions = get_start_positions(pattern)
+        for name in path[len(root_path):]:
+            positions = advance_pattern_positions(pattern, positions, name)
+        if positions:
+            pattern_positions.append((index, positions))
+    return tuple(pattern_positions)
+
+
+#-------------------------------------------------------------------------------
+# start positions of patterns starting at directory path
+#-------------------------------------------------------------------------------
+def get_root_positions(file_patterns: list, path: tuple):
+    return tuple((index, get_start_positions(pattern)) for (index, (_, root_path, pattern)) in enumerate(file_patterns) if root_path == path)
+
+
+#-------------------------------------------------------------------------------
+# match name of an entry in a directory with state (include positions, exclude
+# positions) of the directory, returns None if excluded, or (indexes of include
+# patterns matching it as a file, state of it as a directory)
+#-------------------------------------------------------------------------------
+def get_entry_transition(includes: list, excludes: list, state: tuple, name: str):
+    (include_positions, exclude_positions) = state
+    exclude_positions = [(index, advance_pattern_positions(excludes[index][2], positions, name)) for (index, positions) in exclude_positions]
+    if any(len(excludes[index][2]) in positions for (index, positions) in exclude_positions):
+        return None
+    include_positions = [(index, advance_pattern_positions(includes[index][2], positions, name)) for (index, positions) in include_positions]
+    indexes = [index for (index, positions) in include_positions if len(includes[index][2]) in positions]
+    # keep patterns that can still match below the directory
+    return (indexes, (tuple((index, positions) for (index, positions) in include_positions if any(position < len(includes[index][2]) for position in positions)),
+                      tuple((index, positions) for (index, positions) in exclude_positions if positions)))
+
+
+#-------------------------------------------------------------------------------
+# walk directories once for all include patterns, starting at their fixed
+# leading directories (leaving out those below another).  the positions each
+# pattern has reached in a directory are its state, names are matched once for
+# each state and name (names repeat across directories, e.g. src, main.tf).
+# yields (path, indexes of matching include patterns) of each file not
+# excluded, with path as tuple of absolute path components
+#-------------------------------------------------------------------------------
+def walk_file_patterns(includes: list, excludes: list):
+    root_paths = sorted(set(include[1] for include in includes))
+    walk_paths = [root_path for root_path in root_paths
+                  if not any(root_path[:len(other)] == other for other in root_paths if other != root_path)]
+    # directories on the way to the fixed leading directories of patterns
+    root_parent_paths = set(root_path[:length] for root_path in root_paths for length in range(len(root_path)))
+    pattern_roots = set(include[1] for include in includes) | set(exclude[1] for exclude in excludes)
+    (transitions, visited_dirs) = ({}, set())
+    for walk_path in walk_paths:
+        dirs = [(walk_path, (get_pattern_positions(includes, walk_path), get_pattern_positions(excludes, walk_path)))]
+        while dirs:
+            (dir_path, state) = dirs.pop()
+            try:
+                entries = list(os.scandir('/'.join(dir_path) or '/'))
+            except OSError as e:
+                logger.debug(f"could not list {'/'.join(dir_path)}: {e}")
+                continue
+            for entry in entries:
+                key = (state, entry.name)
+                if key not in transitions:
+                    transitions[key] = get_entry_transition(includes, excludes, state, entry.name)
+                transition = transitions[key]
+                if transition is None:
+                    logger.debug(f"excluding {entry.path}")
+                    continue
+                (indexes, entry_state) = transition
+                if entry.is_file():
+                    if indexes:
+                        yield (dir_path + (entry.name,), indexes)
+                    continue
+                if not entry.is_dir():
+                    continue
+                path = dir_path + (entry.name,)
+                if path in pattern_roots:
+                    entry_state = (tuple(sorted(entry_state[0] + get_root_positions(includes, path))),
+                                   tuple(sorted(entry_state[1] + get_root_positions(excludes, path))))
+                if not entry_state[0] and path not in root_parent_paths:
+                    continue
+                if entry.is_symlink():
+                    # do not loop through links to parent directories
+                    entry_stat = entry.stat()
+                    if (entry_stat.st_dev, entry_stat.st_ino) in visited_dirs:
+                        continue
+                    visited_dirs.add((entry_stat.st_dev, entry_stat.st_ino))
+                dirs.append((path, entry_state))
+
+
 #-------------------------------------------------------------------------------
 # read in yaml struction of each configuration file to array of dictonaries
+# config file urls are read from their local copies (see fetch_config_files)
 #-------------------------------------------------------------------------------
-def read_config_files(config_files: list):
+def read_config_files(config_files: list, cache_dir: str = None, local_config_files: list = None):
+    if local_config_files is None:
+        local_config_files = fetch_config_files(config_files)
+    local_config_files = get_config_files(local_config_files)
+    if cache_dir:
+        cache_dir = get_trusted_cache_dir(cache_dir)
     configs = []
-    for config_file in config_files:
+    for (config_file, local_config_file) in zip(config_files, local_config_files):
         logger.info(f"Parsing config file: {config_file}")
-        with open(config_file) as f:
-            config = yaml.safe_load(f)
+        try:
+            if cache_dir:
+                config = read_cached_config_file(local_config_file, cache_dir)
+            else:
+                with open(local_config_file, 'rb') as f:
+                    config = yaml.load(f, Loader=YAML_LOADER)
+        except yaml.YAMLError as e:
+            raise TailorError(f"ERROR: could not parse config file {config_file} ({e})")
+        except OSError as e:
+            raise TailorError(f"ERROR: could not read config file {config_file} ({e})")
+        if not isinstance(config, dict) or not isinstance(config.get('config'), dict):
+            raise TailorError(f"ERROR: config file {config_file} has no top level 'config' map")
         config['config']['resolved'] = {'source_config_file': config_file}
         configs.append(config['config'])
     return configs
 
 
+#-------------------------------------------------------------------------------
+# get local config files for config files given as http(s) urls, all urls are
+# fetched concurrently in to url_cache_dir, local config files are kept as is
+#-------------------------------------------------------------------------------
+def fetch_config_files(config_files: list, url_cache_dir: str = URL_CACHE_DIR, url_timeout: float = URL_TIMEOUT):
+    config_urls = list(dict.fromkeys(config_file for config_file in config_files if CONFIG_URL_PATTERN.match(config_file)))
+    if not config_urls:
+        return list(config_files)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(config_urls), MAX_URL_FETCHES)) as executor:
+        futures = [executor.submit(fetch_config_url, config_url, url_cache_dir, url_timeout) for config_url in config_urls]
+        cached_config_files = dict(zip(config_urls, [future.result() for future in futures]))
+    return [cached_config_files.get(config_file, config_file) for config_file in config_files]
+
+
+#-------------------------------------------------------------------------------
+# fetch config file url in to url cache and return the name of the cached copy
+# the ETag and Last-Modified headers of the response are kept in a header file
+# next to it and sent back with the next fetch (a conditional request)
+# * 304 not modified: cached copy is still current, nothing is downloaded
+# * url can not be fetched (offline, timeout, 5xx server error): cached copy is
+#   used, other errors (e.g. 404 not found, 403 forbidden) fail
+#-------------------------------------------------------------------------------
+def fetch_config_url(config_url: str, url_cache_dir: str, url_timeout: float):
+    # imported here, runs without config file urls do not need it
+    import urllib.request
+    import urllib.error
+    cache_file_name = os.path.join(url_cache_dir, hashlib.sha256(config_url.encode()).hexdigest())
+    (content_file_name, header_file_name) = (cache_file_name + '.yml', cache_file_name + '.json')
+    cached = os.path.isfile(content_file_name)
+    cached_header = {}
+    if cached:
+        try:
+            with open(header_file_name) as f:
+                cached_header = json.load(f)
+        except Exception:
+            logger.warning(f"Could not read cache file {header_file_name}, fetching {config_url} again")
+        if cached_header.get('version') != URL_CACHE_VERSION or cached_header.get('url') != config_url:
+            cached_header = {}
+
+    request = urllib.request.Request(config_url)
+    if cached_header.get('etag'):
+        request.add_header('If-None-Match', cached_header['etag'])
+    if cached_header.get('last_modified'):
+        request.add_header('If-Modified-Since', cached_header['last_modified'])
+    try:
+        with urllib.request.urlopen(request, timeout=url_timeout) as response:
+            content = response.read()
+            header = {'version': URL_CACHE_VERSION, 'url': config_url,
+                      'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached_header:
+            logger.debug(f"using cached {config_url} from {content_file_name}, not modified")
+            return content_file_name
+        if e.code < 500:
+            # e.g. removed (404) or access revoked (401, 403), the cached copy
+            # is no longer valid
+            raise TailorError(f"ERROR: could not fetch config file {config_url} ({e})")
+        error = e
+    except (urllib.error.URLError, OSError) as e:
+        error = e
+    else:
+        logger.debug(f"fetched {config_url} in to {content_file_name}")
+        write_url_cache_files(content_file_name, content, header_file_name, header)
+        return content_file_name
+
+    if cached:
+        logger.warning(f"Could not fetch {config_url} ({error}), using cached copy {content_file_name}")
+        return content_file_name
+    raise TailorError(f"ERROR: could not fetch config file {config_url} ({error})")
+
+
+#-------------------------------------------------------------------------------
+# write fetched config file and its header to url cache, an unchanged config
+# file is not written again, to keep its mtime for the parsed config cache
+#-------------------------------------------------------------------------------
+def write_url_cache_files(content_file_name: str, content: bytes, header_file_name: str, header: dict):
+    try:
+        os.makedirs(os.path.dirname(content_file_name) or os.curdir, mode=0o700, exist_ok=True)
+        unchanged = False
+        if os.path.isfile(content_file_name) and os.path.getsize(content_file_name) == len(content):
+            with open(content_file_name, 'rb') as f:
+                unchanged = f.read() == content
+        if not unchanged:
+            with open_output_file(content_file_name, 'wb') as f:
+                f.write(content)
+        with open_output_file(header_file_name, 'w') as f:
+            json.dump(header, f)
+    except OSError as e:
+        raise TailorError(f"ERROR: could not write url cache file {content_file_name} ({e})") from e
+
+
+#-------------------------------------------------------------------------------
+# cached config files are pickles, and loading a pickle can run any code, so
+# a cache directory (e.g. restored from a shared ci cache) is only used when it
+# is owned by the current user and not writable by group or others, else None
+#-------------------------------------------------------------------------------
+def get_trusted_cache_dir(cache_dir: str):
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        trusted = is_trusted_cache_stat(os.stat(cache_dir))
+    except OSError:
+        trusted = False
+    if not trusted:
+        logger.warning(f"Not using cache dir {cache_dir}, it must be a directory owned by the current user and not writable by group or others")
+        return None
+    return cache_dir
+
+
+#-------------------------------------------------------------------------------
+# check if a cache directory or file is owned by the current user and not
+# writable by group or others
+#-------------------------------------------------------------------------------
+def is_trusted_cache_stat(cache_stat: os.stat_result):
+    return cache_stat.st_uid == os.getuid() and not cache_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+#-------------------------------------------------------------------------------
+# read parsed config file from cache, or parse and add it to the cache
+# each cache file holds a header, matched against the config file, followed by
+# the parsed config
+# * same size and mtime: config file is unchanged, no need to read it
+# * otherwise same content hash: unchanged (e.g. fresh checkout), header updated
+#-------------------------------------------------------------------------------
+def read_cached_config_file(config_file: str, cache_dir: str):
+    cache_file_name = os.path.join(cache_dir, hashlib.sha256(os.path.abspath(config_file).encode()).hexdigest() + '.pickle')
+    config_file_stat = os.stat(config_file)
+    header = {'version': CONFIG_CACHE_VERSION, 'loader': YAML_LOADER.__name__, 'path': os.path.abspath(config_file),
+              'size': config_file_stat.st_size, 'mtime_ns': config_file_stat.st_mtime_ns, 'content_hash': None}
+    cached_header = {}
+    try:
+        with open_trusted_cache_file(cache_file_name) as f:
+            cached_header = pickle.load(f)
+            if all(cached_header.get(key) == header[key] for key in ['version', 'loader', 'path', 'size', 'mtime_ns']):
+                logger.debug(f"using cached {config_file} from {cache_file_name}")
+                return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not read cache file {cache_file_name} ({e}), parsing {config_file}")
+
+    with open(config_file, 'rb') as f:
+        content = f.read()
+    header['content_hash'] = hashlib.sha256(content).hexdigest()
+    config = None
+    if all(cached_header.get(key) == header[key] for key in ['version', 'loader', 'path', 'content_hash']):
+        try:
+            with open_trusted_cache_file(cache_file_name) as f:
+                pickle.load(f)
+                config = pickle.load(f)
+            logger.debug(f"using cached {config_file} from {cache_file_name}, content unchanged")
+        except Exception:
+            logger.warning(f"Could not read cache file {cache_file_name}, parsing {config_file}")
+    if config is None:
+        config = yaml.load(content, Loader=YAML_LOADER)
+    write_cached_config_file(cache_file_name, header, config)
+    return config
+
+
+#-------------------------------------------------------------------------------
+# open cache file for reading, failing with PermissionError if it is not owned
+# by the current user or writable by group or others (see get_trusted_cache_dir)
+#-------------------------------------------------------------------------------
+def open_trusted_cache_file(cache_file_name: str):
+    f = open(cache_file_name, 'rb')
+    if not is_trusted_cache_stat(os.fstat(f.fileno())):
+        f.close()
+        raise PermissionError("not owned by the current user or writable by group or others")
+    return f
+
+
+#-------------------------------------------------------------------------------
+# write parsed config file to cache, failing to do so is not an error
+#-------------------------------------------------------------------------------
+def write_cached_config_file(cache_file_name: str, header: dict, config: map):
+    tempfile_name = None
+    try:
+        os.makedirs(os.path.dirname(cache_file_name), mode=0o700, exist_ok=True)
+        (fd, tempfile_name) = tempfile.mkstemp(dir=os.path.dirname(cache_file_name))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(config, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tempfile_name, cache_file_name)
+    except Exception:
+        logger.warning(f"Could not write cache file {cache_file_name}")
+        if tempfile_name and os.path.isfile(tempfile_name):
+            os.remove(tempfile_name)
+
+
+#-------------------------------------------------------------------------------
+# remove all cached config files
+#-------------------------------------------------------------------------------
+def clear_config_cache(cache_dir: str):
+    if not os.path.isdir(cache_dir):
+        return
+    logger.info(f"clearing config cache {cache_dir}")
+    for cache_file_name in glob.glob(os.path.join(cache_dir, '*.pickle')):
+        os.remove(cache_file_name)
+
+
 #-------------------------------------------------------------------------------
 # create a single structure to represent all config resolution
+# with keys, only those top level keys (and resolved_keys) are added
 #-------------------------------------------------------------------------------
-def consolidate_configs(configs: list, resolved_keys: dict):
+def consolidate_configs(configs: list, resolved_keys: dict, keys: set = None):
     consolidated_config = {'config': {}}
     for config in reversed(configs):
         logger.debug(f"Adding resolved values from {config['resolved']['source_config_file']}")
-        merge_keys(config['defaults'], config['resolved'], True)
-        merge_keys(consolidated_config['config'], config['defaults'], True)
+        if keys is None:
+            merge_keys(config['defaults'], config['resolved'], True)
+            merge_keys(consolidated_config['config'], config['defaults'], True)
+            continue
+        merge_keys(config['defaults'], {key: config['resolved'][key] for key in keys if key in config['resolved']}, True)
+        merge_keys(consolidated_config['config'], {key: config['defaults'][key] for key in keys if key in config['defaults']}, True)
     merge_keys(consolidated_config['config'], resolved_keys, True)
     return consolidated_config
 
 
+#-------------------------------------------------------------------------------
+# consolidate only the top level keys needed for tokens and the tokens nested in
+# their values, returns (config map, config index).  resolution already only
+# follows the value of each resolved key, so the keys skipped here are the bulk
+# of shared configs that no tailor file uses
+# the config index holds the same value for each of these tokens as the index
+# of the whole config map
+#-------------------------------------------------------------------------------
+def consolidate_referenced_configs(configs: list, resolved_keys: dict, tokens: set):
+    keys = {'ignore_keys'}
+    while True:
+        keys |= get_token_keys(tokens)
+        config_map = consolidate_configs(configs, resolved_keys, keys)
+        config_index = index_config_map(config_map)
+        tokens = get_referenced_tokens(tokens, config_map, config_index, [])
+        if get_token_keys(tokens) <= keys:
+            break
+    unreferenced_keys = set().union(*[config['defaults'].keys() | config['resolved'].keys() for config in configs]) - keys - resolved_keys.keys()
+    logger.info(f"referenced only: {len(config_map['config'])} key(s) consolidated, {len(unreferenced_keys)} unreferenced key(s) left out")
+    logger.debug(f"unreferenced keys: {', '.join(sorted(map(str, unreferenced_keys)))}")
+    return (config_map, config_index)
+
+
+#-------------------------------------------------------------------------------
+# top level keys a token can resolve from, any segment of a dotted token can
+# be found at top level (see get_token_value)
+#-------------------------------------------------------------------------------
+def get_token_keys(tokens: set):
+    return {segment for token in tokens for segment in token.split('.')}
+
+
 #-------------------------------------------------------------------------------
 # parse config files and resolve nodes of matching resolvable_keys and add to
 # resolved_keys
+# configs are resolved in passes like the previous fixed-point resolver (kept in
+# bench-tailor.py to check both give the same result), but a node is only
+# visited again if its last visit changed something or a resolvable key it is
+# waiting on has been found since.  any other visit would change nothing, so
+# the result is the same
+# configs are not changed, nodes are copied when first visited (see get_own_node)
 #-------------------------------------------------------------------------------
 def resolve_configs(resolvable_keys: list, configs: list, resolved_keys: dict):
+    settled_nodes = {}
+    own_nodes = {}
+    configs = [get_own_node(config, own_nodes) for config in configs]
     fully_resolved = False
     while not fully_resolved:
         fully_resolved = True
-        for config in configs:
-            logger.debug(f"Parsing config tree for {config['resolved']['source_config_file']}")
-            resolution_occured = colapse_and_get_ordered_list_keys(resolvable_keys, config, resolved_keys)
-            if resolution_occured:
-                fully_resolved = False
+        count_profile('resolution_passes')
+        with profile_phase('resolve pass'):
+            for config in configs:
+                (resolution_occured, _, _) = resolve_node(resolvable_keys, config, resolved_keys, settled_nodes, own_nodes)
+                if resolution_occured:
+                    fully_resolved = False
     return configs
 
 
-#-------------------------------------------------------------------------------
-# check if any unresolved orderd keys are in list
-#-------------------------------------------------------------------------------
-def check_for_unresolved_resolvable_keys(resolvable_keys: list, config_node: map):
-    for resolvable_key in resolvable_keys:
-        if resolvable_key in config_node:
-            if not isinstance(config_node[resolvable_key], (str, int, float, bool)):
-                return True
-    return False
-
-
 #-------------------------------------------------------------------------------
 # iterate through keys in tree that match resolvable_keys (descending) and find
-# element matching value for specified key, and bring back to top level
-# as default keys
+# element matching value for specified key, and bring back to top level as
+# default keys, keeping track of changes
+# * settled_nodes holds nodes not changed by their last visit, with the keys
+#   they are waiting on, these are skipped until one of those keys is found
+# * own_nodes holds the copies of visited nodes
+# * returns (resolution_occured, changed, waiting_keys)
 #-------------------------------------------------------------------------------
-def colapse_and_get_ordered_list_keys(resolvable_keys: list, config_node: map, resolved_keys: dict):
-    move_leaf_keys_to_resolved_key_list(config_node)
+def resolve_node(resolvable_keys: list, config_node: map, resolved_keys: dict, settled_nodes: dict, own_nodes: dict):
+    if id(config_node) in settled_nodes:
+        waiting_keys = settled_nodes[id(config_node)][1]
+        if not any(key in resolved_keys for key in waiting_keys):
+            count_profile('nodes_skipped')
+            return (False, False, waiting_keys)
+        del settled_nodes[id(config_node)]
+
+    changed = move_leaf_keys_to_resolved_key_list(config_node)
     resolution_occured = False
+    waiting_keys = set()
     for key in list(config_node):
         if key in ['resolved', 'defaults']:
             continue
         if key not in resolvable_keys:
             logger.warning(f"Unknown element structure '{key}' at top level")
-            logger.debug(f"{yaml.dump(config_node)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"{debug_yaml_dump(config_node)}")
+            continue
+        node = config_node[key] = get_own_node(config_node[key], own_nodes)
+        changed |= move_leaf_keys_to_resolved_key_list(node)
+        if key not in resolved_keys:
+            waiting_keys.add(key)
             continue
-        node = config_node[key]
-        move_leaf_keys_to_resolved_key_list(node)
-        for resolvable_key in resolvable_keys:
-            if key == resolvable_key:                                               # is key that should be resolvable
-                if key in resolved_keys:                                            # key has resolvable value
-                    merge_keys(node['defaults'], node['resolved'], True)
-                    merge_keys(config_node['defaults'], node['defaults'], True)
-                    if resolved_keys[key] not in node:                              # value does not exist in list, cannot be resolved
-                        del(config_node[key])                                       # delete key
-                        resolution_occured = True
-                        continue
 
-                    resolved_node = node[resolved_keys[key]]
-                    resolution_occured = colapse_and_get_ordered_list_keys(resolvable_keys, resolved_node, resolved_keys)
+        changed |= merge_keys(node['defaults'], node['resolved'], True)
+        changed |= merge_keys(config_node['defaults'], node['defaults'], True)
+        if resolved_keys[key] not in node:                                  # value does not exist in list, cannot be resolved
+            del(config_node[key])
+            resolution_occured = changed = True
+            continue
 
-                    # if there are unresolved sub structures that are resolvable, do no delete this node
-                    move_leaf_keys_to_resolved_key_list(resolved_node)
-                    merge_keys(resolved_node['defaults'], resolved_node['resolved'], True)
-                    # merge_keys(node['defaults'], node['resolved'], True)
-                    merge_keys(node['defaults'], resolved_node['defaults'], True)
-                    merge_keys(config_node['defaults'], node['defaults'], True)
-                    update_resolved_keys(config_node['defaults'], resolvable_keys, resolved_keys)
-                    if check_for_unresolved_resolvable_keys(resolvable_keys, resolved_node):
-                        logger.debug(f"found more ordered keys in {resolved_keys[key]}\n:{yaml.dump(resolved_node)}")
-                        break
+        resolved_node = node[resolved_keys[key]] = get_own_node(node[resolved_keys[key]], own_nodes)
+        (resolution_occured, node_changed, node_waiting_keys) = resolve_node(resolvable_keys, resolved_node, resolved_keys, settled_nodes, own_nodes)
+        changed |= node_changed
+        waiting_keys |= node_waiting_keys
 
-                    del(config_node[key])
-                    resolution_occured = True
+        # changes made here to resolved_node also count as changes to it
+        resolved_node_changed = move_leaf_keys_to_resolved_key_list(resolved_node)
+        resolved_node_changed |= merge_keys(resolved_node['defaults'], resolved_node['resolved'], True)
+        if resolved_node_changed:
+            settled_nodes.pop(id(resolved_node), None)
+        changed |= resolved_node_changed
+        changed |= merge_keys(node['defaults'], resolved_node['defaults'], True)
+        changed |= merge_keys(config_node['defaults'], node['defaults'], True)
+        changed |= update_resolved_keys(config_node['defaults'], resolvable_keys, resolved_keys)
+        if check_for_unresolved_resolvable_keys(resolvable_keys, resolved_node):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"found more ordered keys in {resolved_keys[key]}\n:{debug_yaml_dump(resolved_node)}")
+            continue
 
-    return resolution_occured
+        del(config_node[key])
+        resolution_occured = changed = True
+
+    count_profile('nodes_changed' if changed else 'nodes_unchanged')
+    if changed:
+        settled_nodes.pop(id(config_node), None)
+    else:
+        # keep a reference to the node, so its id is not reused while in settled_nodes
+        settled_nodes[id(config_node)] = (config_node, waiting_keys)
+    return (resolution_occured, changed, waiting_keys)
+
+
+#-------------------------------------------------------------------------------
+# copy on write of config nodes for resolve_configs, instead of a deepcopy of
+# all configs.  resolution only changes the nodes it visits and their
+# 'defaults' and 'resolved' dicts (merge_keys moves values by reference and
+# never changes them), so only those are copied, shallow, when first visited.
+# all other subtrees stay shared with the parsed configs.
+# own_nodes maps the id of each original and copy to the copy, so a node
+# shared through yaml anchors stays shared, as with deepcopy
+#-------------------------------------------------------------------------------
+def get_own_node(node: map, own_nodes: dict):
+    node = get_own_dict(node, own_nodes)
+    for key in ['defaults', 'resolved']:
+        if isinstance(node, dict) and key in node:
+            node[key] = get_own_dict(node[key], own_nodes)
+    return node
+
+
+#-------------------------------------------------------------------------------
+# shallow copy of dict, made once for each original
+#-------------------------------------------------------------------------------
+def get_own_dict(node: map, own_nodes: dict):
+    if not isinstance(node, dict):
+        return node
+    # originals are part of the parsed configs, so their ids are not reused
+    if id(node) not in own_nodes:
+        own_node = dict(node)
+        own_nodes[id(node)] = own_nodes[id(own_node)] = own_node
+    return own_nodes[id(node)]
+
+
+#-------------------------------------------------------------------------------
+# check if any unresolved orderd keys are in list
+#-------------------------------------------------------------------------------
+def check_for_unresolved_resolvable_keys(resolvable_keys: list, config_node: map):
+    for resolvable_key in resolvable_keys:
+        if resolvable_key in config_node:
+            if not isinstance(config_node[resolvable_key], (str, int, float, bool)):
+                return True
+    return False
 
 
 #-------------------------------------------------------------------------------
 # create new list of resoved keys under node for each leaf, and remove leaf key
 #-------------------------------------------------------------------------------
 def move_leaf_keys_to_resolved_key_list(node: map):
+    changed = False
     if 'resolved' not in node:
         node['resolved'] = {}
+        changed = True
     if 'defaults' not in node:
         node['defaults'] = {}
+        changed = True
     for key in list(node):
         if isinstance(node[key], (str, int, float, bool)):
             node['resolved'][key] = node[key]
             del(node[key])
+            changed = True
+    return changed
 
 
 #-------------------------------------------------------------------------------
-# merge all keys from list_of_keys to node[key_in_node]
+# merge all keys from list_of_keys to node[key_in_node], returns True if any
+# key was added or changed
 #-------------------------------------------------------------------------------
 def merge_keys(node_to: map, node_from: map, overwrite: bool):
+    changed = False
     for key in node_from:
-        if not overwrite and key in node_to:        # if overwrite not true and key already exists, skip
-            continue
+        if key in node_to:
+            if not overwrite:                       # if overwrite not true and key already exists, skip
+                continue
+            if is_same_value(node_to[key], node_from[key]):
+                continue
         node_to[key] = node_from[key]
+        changed = True
+    return changed
+
+
+#-------------------------------------------------------------------------------
+# check if two config values are the same object or equal scalars of one type
+#-------------------------------------------------------------------------------
+def is_same_value(value: object, other_value: object):
+    if value is other_value:
+        return True
+    return type(value) is type(other_value) and isinstance(value, (str, int, float, bool)) and value == other_value
 
 
 #-------------------------------------------------------------------------------
@@ -244,93 +837,1165 @@ def merge_keys(node_to: map, node_from: map, overwrite: bool):
 # not already present
 #-------------------------------------------------------------------------------
 def update_resolved_keys(keylist: map, resolvable_keys: list, resolved_keys: dict):
+    changed = False
     for key in keylist:
         if key in resolvable_keys and key not in resolved_keys:
             resolved_keys[key] = keylist[key]
             logger.debug(f"Found ordered key {key} as {keylist[key]}")
+            changed = True
+    return changed
 
 
 #-------------------------------------------------------------------------------
-# print resolved structure to yaml file
+# print resolved structure to file, in the format of its extension (see
+# RESOLVED_FILE_FORMATS).  resolved_dumps keeps the dump of each format, so
+# the same config map is only dumped once
 #-------------------------------------------------------------------------------
-def print_config_map(resolved_paramers_filename, config_map):
+def print_config_map(resolved_paramers_filename, config_map, resolved_dumps: dict = None):
     logger.info(f"writing all resolved keys to {resolved_paramers_filename}")
-    with open(resolved_paramers_filename, 'w') as f:
-        yaml.dump(config_map, f)
+    resolved_format = get_resolved_file_format(resolved_paramers_filename)
+    if resolved_dumps is None:
+        resolved_dumps = {}
+    if resolved_format not in resolved_dumps:
+        resolved_dumps[resolved_format] = dump_config_map(config_map, resolved_format)
+    with open(resolved_paramers_filename, 'wb') as f:
+        f.write(resolved_dumps[resolved_format])
+
+
+#-------------------------------------------------------------------------------
+# format of resolved file, e.g. tailor.json -> json, tailor.yml -> yaml
+# resolved files are not written or read as pickle, loading one can run any
+# code, e.g. of a resolved file changed while handed between pipeline stages
+#-------------------------------------------------------------------------------
+def get_resolved_file_format(resolved_paramers_filename: str):
+    extension = os.path.splitext(resolved_paramers_filename)[1].lower()
+    if extension == '.pickle':
+        raise TailorError(f"ERROR: resolved file {resolved_paramers_filename} can not be a pickle file, use a .json resolved file instead")
+    return RESOLVED_FILE_FORMATS.get(extension, 'yaml')
+
+
+#-------------------------------------------------------------------------------
+# dump config map as bytes of yaml (using libyaml if PyYAML was built with
+# it) or json
+#-------------------------------------------------------------------------------
+def dump_config_map(config_map: map, resolved_format: str):
+    if resolved_format == 'json':
+        try:
+            return json.dumps(config_map).encode()
+        except TypeError as e:
+            raise TailorError(f"ERROR: could not write resolved keys as json ({e}), use a .yml resolved file")
+    return yaml.dump(config_map, Dumper=YAML_DUMPER).encode()
+
+
+#-------------------------------------------------------------------------------
+# read config map of an earlier run from a yaml or json resolved file
+#-------------------------------------------------------------------------------
+def read_resolved_file(resolved_paramers_filename: str):
+    logger.info(f"reading resolved keys from {resolved_paramers_filename}")
+    resolved_format = get_resolved_file_format(resolved_paramers_filename)
+    try:
+        with open(resolved_paramers_filename, 'rb') as f:
+            if resolved_format == 'json':
+                config_map = json.load(f)
+            else:
+                config_map = yaml.load(f, Loader=YAML_LOADER)
+    except Exception as e:
+        raise TailorError(f"ERROR: could not read resolved file {resolved_paramers_filename} ({e})")
+    if not isinstance(config_map, dict) or not isinstance(config_map.get('config'), dict):
+        raise TailorError(f"ERROR: resolved file {resolved_paramers_filename} has no config map")
+    return config_map
 
 
 #-------------------------------------------------------------------------------
 # parse each file in list and rewite as new file with tokens replaced
+# with jobs > 1 files are tailored by a pool of processes, log messages of each
+# file are passed back and written in the order of the tailor files list
+# with output_mode 'dry-run' or 'diff' nothing is written, with 'diff' the
+# differences to the existing tailored files are printed
+#-------------------------------------------------------------------------------
+def substitue_keys_in_tailor_files(tailor_files: list, config_map: map, config_index: dict, jobs: int = 1, output_dir: str = None, ignore_keys: list = None,
+                                   output_mode: str = 'write'):
+    ignore_keys = ignore_keys or []
+    if jobs <= 1 or len(tailor_files) <= 1:
+        for tailor_file_name in tailor_files:
+            sys.stdout.write(tailor_file(tailor_file_name, config_map, config_index, output_dir, ignore_keys, output_mode))
+        return
+
+    logger.debug(f"tailoring {len(tailor_files)} files using {jobs} processes")
+    chunksize = max(1, len(tailor_files) // (jobs * 4))
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_tailor_worker,
+                                                      initargs=(config_map, config_index, output_dir, ignore_keys, output_mode, logger.getEffectiveLevel(), profile is not None))
+    run_worker_tasks(executor, tailor_file_worker, tailor_files, chunksize)
+
+
+#-------------------------------------------------------------------------------
+# run tasks in a pool of worker processes, each returning (log records, error
+# message or None, profile, diff).  results are handled in the order of the
+# tasks: log records are written, diffs printed and profiles merged.  on the
+# first failed task all tasks not yet started are cancelled and its error is
+# raised
+#-------------------------------------------------------------------------------
+def run_worker_tasks(executor: concurrent.futures.Executor, worker, tasks: list, chunksize: int = 1):
+    try:
+        for (log_records, error, worker_profile, diff) in executor.map(worker, tasks, chunksize=chunksize):
+            for log_record in log_records:
+                logger.handle(log_record)
+            sys.stdout.write(diff)
+            merge_profile(worker_profile)
+            if error:
+                raise TailorError(error)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+#-------------------------------------------------------------------------------
+# set up globals in each worker process
+#-------------------------------------------------------------------------------
+def init_tailor_worker(worker_config_map: map, worker_config_index: dict, output_dir: str, ignore_keys: list, output_mode: str, log_level: int, profiling: bool):
+    global worker_config
+    worker_config = (worker_config_map, worker_config_index, output_dir, ignore_keys, output_mode)
+    init_worker_logger(log_level)
+    init_worker_profile(profiling)
+
+
+#-------------------------------------------------------------------------------
+# tailor a single file in a worker process and return (log records, error
+# message or None, profile, diff)
+#-------------------------------------------------------------------------------
+def tailor_file_worker(tailor_file_name: str):
+    (error, diff) = (None, '')
+    try:
+        diff = tailor_file(tailor_file_name, *worker_config)
+    except TailorError as e:
+        error = str(e)
+    except Exception:
+        error = f"ERROR: could not tailor {tailor_file_name}\n{traceback.format_exc()}"
+    return (get_worker_log_records(), error, get_worker_profile(), diff)
+
+
+#-------------------------------------------------------------------------------
+# log records of worker processes are kept in a buffer and returned to the
+# main process with the result of each task
+#-------------------------------------------------------------------------------
+def init_worker_logger(log_level: int):
+    global logger, worker_log_buffer
+    # capacity is never reached, records are taken from the buffer after each task
+    worker_log_buffer = logging.handlers.BufferingHandler(sys.maxsize)
+    logger = logging.getLogger(os.path.basename(__file__))
+    logger.handlers = [worker_log_buffer]
+    logger.propagate = False
+    logger.setLevel(log_level)
+
+
+#-------------------------------------------------------------------------------
+# take log records of last task from buffer
+#-------------------------------------------------------------------------------
+def get_worker_log_records():
+    log_records = []
+    for log_record in worker_log_buffer.buffer:
+        # format message here so records can be sent back to the main process
+        log_record.msg = log_record.getMessage()
+        if log_record.exc_info:
+            log_record.msg += '\n' + logging.Formatter().formatException(log_record.exc_info)
+        log_record.args = None
+        log_record.exc_info = None
+        log_records.append(log_record)
+    worker_log_buffer.buffer.clear()
+    return log_records
+
+
+#-------------------------------------------------------------------------------
+# with --profile, times and counts of worker processes are kept per task and
+# returned to the main process with the log records
+#-------------------------------------------------------------------------------
+def init_worker_profile(profiling: bool):
+    global profile
+    profile = new_profile() if profiling else None
+
+
+#-------------------------------------------------------------------------------
+# take profile of last task, None if not profiling
+#-------------------------------------------------------------------------------
+def get_worker_profile():
+    global profile
+    worker_profile = profile
+    if profile is not None:
+        profile = new_profile()
+    return worker_profile
+
+
+#-------------------------------------------------------------------------------
+# name of file written for a tailor file
 # * remove file prefix 'tailor-template-'
 # * remove directory 'tailor-template/'
 # * otherwise rewrite original file
 #-------------------------------------------------------------------------------
-def substitue_keys_in_tailor_files(tailor_files: list, config_map: map):
-    for tailor_file_name in tailor_files:
-        new_tailor_file_name = re.sub('tailor-template-', '', tailor_file_name)
-        new_tailor_file_name = re.sub('tailor-template/', '', new_tailor_file_name)
+def get_tailored_file_name(tailor_file_name: str):
+    new_tailor_file_name = re.sub('tailor-template-', '', tailor_file_name)
+    return re.sub('tailor-template/', '', new_tailor_file_name)
 
-        try:
-            tempfile_name = tempfile.mkstemp()[1]
-            logger.info(f"tailoring {tailor_file_name} and writing to {new_tailor_file_name}")
-            with open(tailor_file_name, "r") as infile, open(tempfile_name, "w") as outfile:
-                for line in infile:
-                    new_line = line
-                    while re.findall(r'\{\{\s*([\w\.]+?)\s*\}\}', new_line):
-                        new_line = re.sub(r'\{\{\s*([\w\.]+?)\s*\}\}', lambda m: get_token_replacement(m, config_map), new_line)
-                    while re.findall(r'\{\%([\w\.]+?)\%\}', new_line):
-                        # change each occurense of {%key%} to {{key}}
-                        new_line = re.sub(r'\{\%([\w\.]+?)\%\}', f'{{{{\\1}}}}', new_line)
-                        # new_line = re.sub(r'{%([\w\.]+?)%}', f'{{{re.Match.group(1)}}}', new_line)
-                    outfile.write(new_line)
-
-            if os.path.isfile(new_tailor_file_name):
-                os.remove(new_tailor_file_name)
-            shutil.move(tempfile_name, new_tailor_file_name)
-        finally:
-            if os.path.isfile(tempfile_name):
-                os.remove(tempfile_name)
+
+#-------------------------------------------------------------------------------
+# name of file written for a tailor file, with output_dir set the tailored file
+# is written below it at the same path relative to the current directory
+# (absolute paths outside of the current directory are mirrored in full)
+#-------------------------------------------------------------------------------
+def get_output_file_name(tailor_file_name: str, output_dir: str):
+    new_tailor_file_name = get_tailored_file_name(tailor_file_name)
+    if not output_dir:
+        return new_tailor_file_name
+    relative_file_name = os.path.relpath(os.path.abspath(new_tailor_file_name))
+    if relative_file_name.startswith(os.pardir + os.sep):
+        relative_file_name = os.path.abspath(new_tailor_file_name).lstrip(os.sep)
+    return os.path.join(output_dir, relative_file_name)
 
 
 #-------------------------------------------------------------------------------
-# function for re replacement
+# rewite a single tailor file as new file with tokens replaced, returns diff
+# with output_mode 'diff', else ''
+#-------------------------------------------------------------------------------
+def tailor_file(tailor_file_name: str, config_map: map, config_index: dict, output_dir: str = None, ignore_keys: list = None, output_mode: str = 'write'):
+    ignore_keys = ignore_keys or []
+    new_tailor_file_name = get_output_file_name(tailor_file_name, output_dir)
+    with profile_file(tailor_file_name, new_tailor_file_name, output_mode):
+        return tailor_file_contents(tailor_file_name, new_tailor_file_name, config_map, config_index, output_dir, ignore_keys, output_mode)
+
+
+#-------------------------------------------------------------------------------
+# write tailored file, tokens are replaced in text files, binary files are
+# copied unchanged.  files are written next to the tailored file and renamed
+# in to place, so a tailored file is never left half written
+#-------------------------------------------------------------------------------
+def tailor_file_contents(tailor_file_name: str, new_tailor_file_name: str, config_map: map, config_index: dict, output_dir: str, ignore_keys: list, output_mode: str):
+    expansions = {}
+    binary = is_binary_file(tailor_file_name)
+    dry_run = 'dry run: ' if output_mode != 'write' else ''
+    if binary:
+        if new_tailor_file_name == tailor_file_name:
+            logger.info(f"skipping binary file {tailor_file_name}")
+            return ''
+        logger.info(f"{dry_run}copying binary file {tailor_file_name} to {new_tailor_file_name}")
+    else:
+        logger.info(f"{dry_run}tailoring {tailor_file_name} and writing to {new_tailor_file_name}")
+    if dry_run:
+        return diff_tailor_file(tailor_file_name, new_tailor_file_name, config_map, config_index, ignore_keys, binary, output_mode)
+
+    if output_dir:
+        os.makedirs(os.path.dirname(new_tailor_file_name), exist_ok=True)
+    if binary:
+        with open(tailor_file_name, "rb") as infile, open_output_file(new_tailor_file_name, "wb") as outfile:
+            shutil.copyfileobj(infile, outfile)
+    else:
+        with open(tailor_file_name, "r") as infile, open_output_file(new_tailor_file_name, "w") as outfile:
+            for lines in read_tailor_file_chunks(infile):
+                outfile.write(''.join([render_line(line, config_map, config_index, ignore_keys, expansions) for line in lines]))
+    return ''
+
+
+#-------------------------------------------------------------------------------
+# open temporary file in the directory of file_name, renamed to file_name when
+# closed without error (an atomic replace on the same file system) or removed
+#-------------------------------------------------------------------------------
+@contextlib.contextmanager
+def open_output_file(file_name: str, mode: str):
+    (fd, temp_file_name) = tempfile.mkstemp(dir=os.path.dirname(file_name) or os.curdir, prefix=f".{os.path.basename(file_name)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(temp_file_name, file_name)
+    finally:
+        if os.path.isfile(temp_file_name):
+            os.remove(temp_file_name)
+
+
 #-------------------------------------------------------------------------------
-def get_token_replacement(m: re.Match, config_map: map):
-    token = m.group(1)
+# tailor file in memory, returns unified diff to the existing tailored file
+# with output_mode 'diff', else ''
+#-------------------------------------------------------------------------------
+def diff_tailor_file(tailor_file_name: str, new_tailor_file_name: str, config_map: map, config_index: dict, ignore_keys: list, binary: bool, output_mode: str):
+    exists = os.path.isfile(new_tailor_file_name)
+    if binary:
+        if output_mode == 'diff' and not (exists and filecmp.cmp(tailor_file_name, new_tailor_file_name, shallow=False)):
+            return f"Binary files {new_tailor_file_name if exists else os.devnull} and {tailor_file_name} differ\n"
+        return ''
+
+    expansions = {}
+    with open(tailor_file_name, "r") as infile:
+        tailored_text = ''.join([render_line(line, config_map, config_index, ignore_keys, expansions) for lines in read_tailor_file_chunks(infile) for line in lines])
+    if output_mode != 'diff':
+        return ''
+    existing_text = ''
+    if exists:
+        with open(new_tailor_file_name, "r", errors='replace') as f:
+            existing_text = f.read()
+    diff = difflib.unified_diff(existing_text.splitlines(keepends=True), tailored_text.splitlines(keepends=True),
+                                new_tailor_file_name if exists else os.devnull, new_tailor_file_name)
+    return ''.join([line if line.endswith('\n') else f"{line}\n\\ No newline at end of file\n" for line in diff])
+
+
+#-------------------------------------------------------------------------------
+# check if file is binary (has a null byte or is not valid text in its first
+# block), binary files are never tailored
+#-------------------------------------------------------------------------------
+def is_binary_file(file_name: str):
+    with open(file_name, "rb") as f:
+        block = f.read(BINARY_CHECK_SIZE)
+    if b'\0' in block:
+        return True
+    try:
+        codecs.getincrementaldecoder(locale.getpreferredencoding(False))().decode(block)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+#-------------------------------------------------------------------------------
+# read text file in chunks of CHUNK_SIZE and yield list of lines for each chunk
+# lines longer than CHUNK_SIZE (e.g. minified js) are split in to pieces, cut
+# where no token can cross, so each piece can be tailored on its own with memory
+# bounded by the chunk size
+#-------------------------------------------------------------------------------
+def read_tailor_file_chunks(infile):
+    pending = ''
+    while chunk := infile.read(CHUNK_SIZE):
+        text = pending + chunk
+        end_of_lines = text.rfind('\n') + 1
+        lines = [f"{line}\n" for line in text[:end_of_lines].split('\n')[:-1]]
+        pending = text[end_of_lines:]
+        if len(pending) >= CHUNK_SIZE:
+            # only one position matches SAFE_CUT_PATTERN, look for it near the end first
+            cut_point = (SAFE_CUT_PATTERN.search(pending, len(pending) - CUT_SEARCH_SIZE)
+                         or SAFE_CUT_PATTERN.search(pending)
+                         or PARTIAL_TOKEN_PATTERN.search(pending))
+            cut = cut_point.start() if cut_point else len(pending)
+            lines.append(pending[:cut])
+            pending = pending[cut:]
+        yield lines
+    if pending:
+        yield [pending]
+
+
+#-------------------------------------------------------------------------------
+# replace all tokens in a single line of a tailor file
+# * each {{ key }} is replaced by its fully expanded value
+# * each {%key%} (ignored token) is changed to {{key}} once all tokens are done
+#-------------------------------------------------------------------------------
+def render_line(line: str, config_map: map, config_index: dict, ignore_keys: list, expansions: dict):
+    if '{{' in line:
+        line = substitute_tokens(line, config_map, config_index, ignore_keys, expansions, ())
+    if '{%' in line:
+        # replacement text can never form a new {%key%}, so one pass is enough
+        line = IGNORED_TOKEN_PATTERN.sub(r'{{\1}}', line)
+    return line
+
+
+#-------------------------------------------------------------------------------
+# split text into literal and token segments and join back with the expanded
+# value of each token.  tokens can still be formed across segment boundaries
+# (e.g. '{{ {{ key }} }}'), those are picked up by another pass over the result
+#-------------------------------------------------------------------------------
+def substitute_tokens(text: str, config_map: map, config_index: dict, ignore_keys: list, expansions: dict, expanding: tuple):
+    seen_texts = set()
+    segments = TOKEN_PATTERN.split(text)
+    while len(segments) > 1:
+        if profile is not None:
+            count_profile('tokens_substituted', len(segments) // 2)
+        for i in range(1, len(segments), 2):
+            segments[i] = expand_token(segments[i], config_map, config_index, ignore_keys, expansions, expanding)
+        text = ''.join(segments)
+        if text in seen_texts:
+            raise TailorError(f"ERROR: tokens in '{text.rstrip()}' expand to themselves")
+        seen_texts.add(text)
+        segments = TOKEN_PATTERN.split(text)
+    return text
+
+
+#-------------------------------------------------------------------------------
+# get value of token with any tokens nested in that value expanded as well
+# * expanding holds the chain of tokens currently being expanded to detect cycles
+# * expansions caches fully expanded values for the file being tailored
+#-------------------------------------------------------------------------------
+def expand_token(token: str, config_map: map, config_index: dict, ignore_keys: list, expansions: dict, expanding: tuple):
+    if token in expansions:
+        return expansions[token]
     if token in ignore_keys:
         logger.warning(f"Ignoring token '{token}'")
         # change to non-resolvable syntax
-        return re.sub(r'\{\{(\s*[\w\.]+?\s*)\}\}', f'{{%{token}%}}', m.group(0))
+        value = f'{{%{token}%}}'
+    else:
+        if token in expanding:
+            raise TailorError(f"ERROR: token '{token}' references itself via {' -> '.join(expanding + (token,))}")
+        value = get_token_replacement(token, config_map, config_index)
+        if '{{' in value:
+            value = substitute_tokens(value, config_map, config_index, ignore_keys, expansions, expanding + (token,))
+    expansions[token] = value
+    return value
+
+
+#-------------------------------------------------------------------------------
+# get value of token from config map
+#-------------------------------------------------------------------------------
+def get_token_replacement(token: str, config_map: map, config_index: dict):
+    value = get_token_value(token, config_map, config_index)
+    if value is None:
+        raise TailorError(f"ERROR: token '{token}' could not be resolved")
+    return value
+
+
+#-------------------------------------------------------------------------------
+# flatten config map into an index of dotted key paths to scalar values, e.g.
+# {'tools': {'docker': {'proxy': 'x'}}} -> {'tools.docker.proxy': 'x'}
+# keys that cannot be reached by a token (non-string or containing '.') are
+# left out
+#-------------------------------------------------------------------------------
+def index_config_map(config_map: map):
+    config_index = {}
+    nodes = [('', config_map['config'])]
+    while nodes:
+        (prefix, node) = nodes.pop()
+        for key, value in node.items():
+            if not isinstance(key, str) or '.' in key:
+                continue
+            if isinstance(value, (str, int, float, bool)):
+                config_index[prefix + key] = str(value)
+            elif isinstance(value, dict):
+                nodes.append((f"{prefix}{key}.", value))
+    logger.debug(f"Indexed {len(config_index)} resolved keys")
+    return config_index
+
+
+#-------------------------------------------------------------------------------
+# look up token in config index, falling back to walking the config map for
+# tokens that are not a full path (segments not found in the tree are skipped).
+# the result of the walk, or None if token cannot be resolved, is added to the
+# index so each token is only walked once
+#-------------------------------------------------------------------------------
+def get_token_value(token: str, config_map: map, config_index: dict):
+    if token in config_index:
+        return config_index[token]
     current_node = config_map['config']
+    value = None
     try:
         for nested_token in token.split('.'):
             if nested_token in current_node:
                 current_node = current_node[nested_token]
-        value = current_node
-        assert(isinstance(value, (str, int, float, bool)))
+        if isinstance(current_node, (str, int, float, bool)):
+            value = str(current_node)
     except Exception:
-        logger.error(f"ERROR: token '{token}' could not be resolved")
-        sys.exit(1)
-    return str(value)
+        logger.debug(f"token '{token}' does not match structure of config map")
+    config_index[token] = value
+    return value
+
+
+#-------------------------------------------------------------------------------
+# read each tailor file once and get a hash of its content and the set of
+# tokens used in it, e.g. {'app.tfvars': ('<sha256>', {'region', 'vpc'})}
+# the content hash is only needed for incremental runs, else it is None
+# with jobs > 1 files are scanned by a pool of processes
+#-------------------------------------------------------------------------------
+def scan_tailor_files(tailor_files: list, jobs: int = 1, incremental: bool = False):
+    if jobs <= 1 or len(tailor_files) <= 1:
+        return {tailor_file_name: scan_tailor_file(tailor_file_name, incremental) for tailor_file_name in tailor_files}
+
+    logger.debug(f"scanning {len(tailor_files)} files using {jobs} processes")
+    chunksize = max(1, len(tailor_files) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(tailor_files, executor.map(functools.partial(scan_tailor_file, incremental=incremental), tailor_files, chunksize=chunksize)))
+
+
+#-------------------------------------------------------------------------------
+# get hash of content (with incremental) and set of tokens of a single tailor
+# file, binary files have no tokens and are only read for the hash
+#-------------------------------------------------------------------------------
+def scan_tailor_file(tailor_file_name: str, incremental: bool = False):
+    content_hash = hashlib.sha256() if incremental else None
+    tokens = set()
+    if is_binary_file(tailor_file_name):
+        if incremental:
+            with open(tailor_file_name, "rb") as infile:
+                while chunk := infile.read(CHUNK_SIZE):
+                    content_hash.update(chunk)
+    else:
+        with open(tailor_file_name, "r") as infile:
+            for lines in read_tailor_file_chunks(infile):
+                for line in lines:
+                    if incremental:
+                        content_hash.update(line.encode())
+                    if '{{' in line:
+                        tokens.update(TOKEN_PATTERN.findall(line))
+    return (content_hash.hexdigest() if incremental else None, tokens)
+
+
+#-------------------------------------------------------------------------------
+# get tokens together with all tokens nested in their values
+#-------------------------------------------------------------------------------
+def get_referenced_tokens(tokens: set, config_map: map, config_index: dict, ignore_keys: list):
+    referenced_tokens = set()
+    tokens = list(tokens)
+    while tokens:
+        token = tokens.pop()
+        if token in referenced_tokens:
+            continue
+        referenced_tokens.add(token)
+        if token in ignore_keys:
+            continue
+        value = get_token_value(token, config_map, config_index)
+        if value is not None and '{{' in value:
+            tokens.extend(TOKEN_PATTERN.findall(value))
+    return referenced_tokens
+
+
+#-------------------------------------------------------------------------------
+# find all tokens in tailor files (and tokens nested in their values) that can
+# not be resolved, so a run fails before any file is written
+#-------------------------------------------------------------------------------
+def check_tailor_file_tokens(tailor_file_scans: dict, config_map: map, config_index: dict, ignore_keys: list):
+    unresolved_tokens = {}
+    for tailor_file_name, (_, tokens) in tailor_file_scans.items():
+        for token in get_referenced_tokens(tokens, config_map, config_index, ignore_keys):
+            if token not in ignore_keys and get_token_value(token, config_map, config_index) is None:
+                unresolved_tokens.setdefault(token, []).append(tailor_file_name)
+
+    for token, files in sorted(unresolved_tokens.items()):
+        logger.error(f"ERROR: token '{token}' could not be resolved (used in {', '.join(sorted(files))})")
+    if unresolved_tokens:
+        raise TailorError(f"{len(unresolved_tokens)} token(s) could not be resolved, no files were tailored")
+
+
+#-------------------------------------------------------------------------------
+# name of the incremental manifest, kept next to the resolved file
+# e.g. tailor.yml -> tailor.manifest.json
+#-------------------------------------------------------------------------------
+def get_manifest_file_name(resolved_paramers_filename: str):
+    return f"{os.path.splitext(resolved_paramers_filename)[0]}.manifest.json"
+
+
+#-------------------------------------------------------------------------------
+# read manifest of previous run, a missing or unreadable manifest is empty
+#-------------------------------------------------------------------------------
+def read_manifest(manifest_file_name: str):
+    if not os.path.isfile(manifest_file_name):
+        return {}
+    try:
+        with open(manifest_file_name) as f:
+            return json.load(f)['tailor_files']
+    except Exception:
+        logger.warning(f"Could not read manifest {manifest_file_name}, tailoring all files")
+        return {}
+
+
+#-------------------------------------------------------------------------------
+# write manifest for next run
+#-------------------------------------------------------------------------------
+def write_manifest(manifest_file_name: str, manifest: dict):
+    logger.debug(f"writing manifest of tailored files to {manifest_file_name}")
+    with open(manifest_file_name, 'w') as f:
+        json.dump({'tailor_files': manifest}, f, indent=1, sort_keys=True)
+
+
+#-------------------------------------------------------------------------------
+# hash of the values of all tokens a tailor file references (ignored tokens
+# included, as they are written differently)
+#-------------------------------------------------------------------------------
+def get_token_values_hash(tokens: list, config_map: map, config_index: dict, ignore_keys: list):
+    token_values = [[token, None if token in ignore_keys else get_token_value(token, config_map, config_index), token in ignore_keys] for token in sorted(tokens)]
+    return hashlib.sha256(json.dumps(token_values).encode()).hexdigest()
+
+
+#-------------------------------------------------------------------------------
+# size and modification time of a tailored file, used to check that it was not
+# changed or removed since it was written
+#-------------------------------------------------------------------------------
+def get_file_stamp(file_name: str):
+    if not os.path.isfile(file_name):
+        return None
+    file_stat = os.stat(file_name)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
+#-------------------------------------------------------------------------------
+# get list of tailor files that have to be tailored again, a file is skipped if
+# * its tailored file is unchanged since the last run
+# * its template is unchanged (files tailored in place are covered by above)
+# * all tokens it references still have the same value
+#-------------------------------------------------------------------------------
+def get_changed_tailor_files(tailor_file_scans: dict, manifest: dict, config_map: map, config_index: dict, ignore_keys: list, output_dir: str = None):
+    changed_tailor_files = []
+    for tailor_file_name, (content_hash, _) in tailor_file_scans.items():
+        entry = manifest.get(tailor_file_name)
+        unchanged = (entry is not None
+                     and entry['output'] == get_output_file_name(tailor_file_name, output_dir)
+                     and get_file_stamp(entry['output']) == entry['output_stamp']
+                     and (entry['output'] == tailor_file_name or content_hash == entry['template_hash'])
+                     and get_token_values_hash(entry['tokens'], config_map, config_index, ignore_keys) == entry['values_hash'])
+        if unchanged:
+            logger.debug(f"skipping unchanged {tailor_file_name}")
+        else:
+            changed_tailor_files.append(tailor_file_name)
+    logger.info(f"incremental: {len(tailor_file_scans) - len(changed_tailor_files)} unchanged file(s) skipped, {len(changed_tailor_files)} file(s) to tailor")
+    return changed_tailor_files
+
+
+#-------------------------------------------------------------------------------
+# record state of each tailored file in manifest
+#-------------------------------------------------------------------------------
+def update_manifest(manifest: dict, tailored_files: list, tailor_file_scans: dict, config_map: map, config_index: dict, ignore_keys: list, output_dir: str = None):
+    for tailor_file_name in tailored_files:
+        (content_hash, tokens) = tailor_file_scans[tailor_file_name]
+        referenced_tokens = sorted(get_referenced_tokens(tokens, config_map, config_index, ignore_keys))
+        new_tailor_file_name = get_output_file_name(tailor_file_name, output_dir)
+        manifest[tailor_file_name] = {
+            'template_hash': content_hash,
+            'tokens': referenced_tokens,
+            'values_hash': get_token_values_hash(referenced_tokens, config_map, config_index, ignore_keys),
+            'output': new_tailor_file_name,
+            'output_stamp': get_file_stamp(new_tailor_file_name)
+        }
+    return manifest
+
+
+#-------------------------------------------------------------------------------
+# resolve configs for one set of resolved keys, returns (config map, config
+# index, resolved file dumps by format, filled when written)
+# with tokens, only keys needed for those tokens are consolidated
+# with --serve the result is kept for the same parsed configs and keys
+#-------------------------------------------------------------------------------
+def resolve_config_map(configs: list, resolvable_keys: list, resolved_keys: dict, tokens: set = None):
+    cache_key = (id(configs), tuple(resolvable_keys), tuple(sorted(resolved_keys.items())), None if tokens is None else tuple(sorted(tokens)))
+    if served_config_maps is not None and cache_key in served_config_maps and served_config_maps[cache_key][0] is configs:
+        logger.debug("using resolved keys kept from an earlier request")
+        resolved_keys.update(served_config_maps[cache_key][2])
+        return served_config_maps[cache_key][1]
+    with profile_phase('resolve'):
+        resolved_config = resolve_configs(resolvable_keys, configs, resolved_keys)
+    if tokens is None:
+        with profile_phase('consolidate'):
+            config_map = consolidate_configs(resolved_config, resolved_keys)
+        with profile_phase('index'):
+            config_index = index_config_map(config_map)
+    else:
+        with profile_phase('consolidate referenced'):
+            (config_map, config_index) = consolidate_referenced_configs(resolved_config, resolved_keys, tokens)
+    resolved = (config_map, config_index, {})
+    if served_config_maps is not None:
+        if len(served_config_maps) >= SERVED_CONFIG_MAPS_SIZE:
+            del served_config_maps[next(iter(served_config_maps))]
+        served_config_maps[cache_key] = (configs, resolved, dict(resolved_keys))
+    return resolved
+
+
+#-------------------------------------------------------------------------------
+# resolved keys of configs for a set of defaults, for use as a library, e.g.
+#   resolver = tailor.TailorResolver(['app.yml', 'cloud.yml'], {'environment': 'prod'})
+#   text = resolver.render('bucket = "{{ deploy_bucket }}"')
+#   text = resolver.render(pathlib.Path('tailor-template/main.tfvars'))
+#   resolver.tailor_files(['tailor-template/*.tfvars'], output_dir='build')
+# configs already parsed with read_config_files can be passed instead of
+# config files, to resolve them for more than one set of defaults
+# with tokens, only keys needed for those tokens are resolved (see
+# consolidate_referenced_configs), e.g. the tokens of scanned tailor files
+# a config map read with read_resolved_file can be passed instead, to skip
+# parsing and resolving
+# raises TailorError for anything that can not be resolved or tailored
+#-------------------------------------------------------------------------------
+class TailorResolver:
+    def __init__(self, config_files: list = None, defaults: dict = None, resolve_keys: list = None,
+                 ignore_keys: list = None, cache_dir: str = None, configs: list = None, tokens: set = None, config_map: map = None):
+        self.resolved_keys = dict(defaults or {})
+        self.tokens = tokens
+        if config_map is not None:
+            (self.config_map, self.config_index, self.resolved_dumps) = (config_map, index_config_map(config_map), {})
+        else:
+            if configs is None:
+                if config_files is None:
+                    raise TailorError("ERROR: config files, configs or a config map are needed to resolve keys")
+                configs = read_config_files(config_files, cache_dir)
+            (self.config_map, self.config_index, self.resolved_dumps) = resolve_config_map(configs, get_resolvable_keys_list(resolve_keys or [":AWS_DEFAULT:"]), self.resolved_keys, tokens)
+        # check if config map has a key default.ignore_keys and if so, add to ignore_keys
+        self.ignore_keys = list(ignore_keys or [])
+        if 'ignore_keys' in self.config_map['config']:
+            self.ignore_keys += re.split(',', self.config_map['config']['ignore_keys'])
+
+    # value of a token, tokens nested in the value are not expanded
+    def get_value(self, token: str):
+        return get_token_replacement(token, self.config_map, self.config_index)
+
+    # render text, or the content of a file when given a path (os.PathLike)
+    def render(self, template):
+        expansions = {}
+        if isinstance(template, os.PathLike):
+            if is_binary_file(template):
+                raise TailorError(f"ERROR: {template} is a binary file")
+            with open(template, "r") as infile:
+                return ''.join([render_line(line, self.config_map, self.config_index, self.ignore_keys, expansions)
+                                for lines in read_tailor_file_chunks(infile) for line in lines])
+        return ''.join([render_line(line, self.config_map, self.config_index, self.ignore_keys, expansions)
+                        for lines in read_tailor_file_chunks(io.StringIO(template)) for line in lines])
+
+    # write all resolved keys as yaml or json by extension
+    def write_resolved_file(self, resolved_file_name: str):
+        print_config_map(resolved_file_name, self.config_map, self.resolved_dumps)
+
+    # tailor files matching glob patterns, checking all tokens before any file
+    # is written, returns list of tailor files
+    def tailor_files(self, tailor_file_patterns: list, jobs: int = 1, output_dir: str = None, exclude_files: list = None, output_mode: str = 'write'):
+        jobs = get_jobs(jobs)
+        tailor_files = get_tailor_files(tailor_file_patterns, exclude_files)
+        check_tailor_file_tokens(scan_tailor_files(tailor_files, jobs), self.config_map, self.config_index, self.ignore_keys)
+        substitue_keys_in_tailor_files(tailor_files, self.config_map, self.config_index, jobs, output_dir, self.ignore_keys, output_mode)
+        return tailor_files
+
+
+#-------------------------------------------------------------------------------
+# write resolved file and tailor all scanned tailor files, in place or below
+# output_dir
+# when only referenced keys are resolved, tokens are checked before the
+# resolved file is written
+# with output_mode 'dry-run' or 'diff' no file is written
+# without write_resolved_file the resolved file is only used to name the
+# manifest, e.g. when resolved keys were read from a resolved file
+#-------------------------------------------------------------------------------
+def tailor_configs(resolver: TailorResolver, tailor_file_scans: dict, resolved_file_name: str, output_dir: str, jobs: int, incremental: bool,
+                   output_mode: str = 'write', write_resolved_file: bool = True):
+    (config_map, config_index, ignore_keys) = (resolver.config_map, resolver.config_index, resolver.ignore_keys)
+    if resolver.tokens is not None:
+        with profile_phase('check tokens'):
+            check_tailor_file_tokens(tailor_file_scans, config_map, config_index, ignore_keys)
+    if output_mode != 'write':
+        logger.info(f"dry run: not writing resolved keys to {resolved_file_name}")
+    elif write_resolved_file:
+        with profile_phase('write resolved file'):
+            resolver.write_resolved_file(resolved_file_name)
+    if resolver.tokens is None:
+        with profile_phase('check tokens'):
+            check_tailor_file_tokens(tailor_file_scans, config_map, config_index, ignore_keys)
+    tailor_files = list(tailor_file_scans)
+    if incremental:
+        manifest_file_name = get_manifest_file_name(resolved_file_name)
+        manifest = read_manifest(manifest_file_name)
+        tailor_files = get_changed_tailor_files(tailor_file_scans, manifest, config_map, config_index, ignore_keys, output_dir)
+    with profile_phase('tailor files'):
+        substitue_keys_in_tailor_files(tailor_files, config_map, config_index, jobs, output_dir, ignore_keys, output_mode)
+    if incremental and output_mode == 'write':
+        write_manifest(manifest_file_name, update_manifest(manifest, tailor_files, tailor_file_scans, config_map, config_index, ignore_keys, output_dir))
+
+
+#-------------------------------------------------------------------------------
+# get directory for each matrix set, e.g. with matrix_dir 'tailor-matrix'
+# 'environment=dev,region=us-east-1' -> 'tailor-matrix/environment-dev_region-us-east-1'
+# or with matrix_dir 'build/{environment}/{region}' -> 'build/dev/us-east-1'
+#-------------------------------------------------------------------------------
+def get_matrix_dirs(matrix: list, matrix_dir: str):
+    matrix_dirs = []
+    for matrix_set in matrix:
+        matrix_keys = parse_defaults(matrix_set.split(','))
+        if '{' in matrix_dir:
+            try:
+                matrix_dirs.append(matrix_dir.format(**matrix_keys))
+            except KeyError as e:
+                raise TailorError(f"ERROR: matrix set '{matrix_set}' has no key {e} used in {matrix_dir}")
+            except (ValueError, IndexError, AttributeError) as e:
+                raise TailorError(f"ERROR: --matrix-dir {matrix_dir} is not a valid pattern of {{key}} names ({e})")
+        else:
+            matrix_dirs.append(os.path.join(matrix_dir, '_'.join(f"{key}-{value}" for key, value in matrix_keys.items())))
+    if len(set(matrix_dirs)) != len(matrix_dirs):
+        raise TailorError(f"ERROR: matrix sets do not map to unique directories using {matrix_dir}")
+    return matrix_dirs
+
+
+#-------------------------------------------------------------------------------
+# resolve and tailor each matrix set in to its own directory, configs are only
+# parsed and tailor files only scanned once for all sets
+# with jobs > 1 sets are handled by a pool of processes, log messages of each
+# set are passed back and written in the order of the matrix
+#-------------------------------------------------------------------------------
+def tailor_matrix(matrix: list, matrix_dir: str, configs: list, resolvable_keys: list, defaults: list, base_ignore_keys: list,
+                  tailor_file_scans: dict, resolved_file_name: str, jobs: int, incremental: bool, tokens: set = None, output_mode: str = 'write'):
+    matrix_tasks = []
+    for (matrix_set, output_dir) in zip(matrix, get_matrix_dirs(matrix, matrix_dir)):
+        matrix_tasks.append((matrix_set, defaults + matrix_set.split(','), os.path.join(output_dir, os.path.basename(resolved_file_name)), output_dir))
+    if jobs <= 1 or len(matrix_tasks) <= 1:
+        for (matrix_set, matrix_defaults, matrix_resolved_file_name, output_dir) in matrix_tasks:
+            logger.info(f"matrix: tailoring {matrix_set} in to {output_dir}")
+            if output_mode == 'write':
+                os.makedirs(output_dir, exist_ok=True)
+            resolver = TailorResolver(defaults=parse_defaults(matrix_defaults), resolve_keys=resolvable_keys, ignore_keys=base_ignore_keys, configs=configs, tokens=tokens)
+            tailor_configs(resolver, tailor_file_scans, matrix_resolved_file_name, output_dir, jobs, incremental, output_mode)
+        return
+
+    logger.debug(f"tailoring {len(matrix_tasks)} matrix sets using {jobs} processes")
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_matrix_worker,
+                                                      initargs=(configs, resolvable_keys, base_ignore_keys, tailor_file_scans, incremental, tokens, output_mode, logger.getEffectiveLevel(), profile is not None))
+    run_worker_tasks(executor, matrix_worker, matrix_tasks)
+
+
+#-------------------------------------------------------------------------------
+# set up globals in each matrix worker process
+#-------------------------------------------------------------------------------
+def init_matrix_worker(configs: list, resolvable_keys: list, base_ignore_keys: list, tailor_file_scans: dict, incremental: bool, tokens: set, output_mode: str,
+                       log_level: int, profiling: bool):
+    global worker_matrix_config
+    worker_matrix_config = (configs, resolvable_keys, base_ignore_keys, tailor_file_scans, incremental, tokens, output_mode)
+    init_worker_logger(log_level)
+    init_worker_profile(profiling)
+
+
+#-------------------------------------------------------------------------------
+# resolve and tailor a single matrix set in a worker process and return
+# (log records, error message or None, profile, diff)
+#-------------------------------------------------------------------------------
+def matrix_worker(matrix_task: tuple):
+    (matrix_set, matrix_defaults, matrix_resolved_file_name, output_dir) = matrix_task
+    (configs, resolvable_keys, base_ignore_keys, tailor_file_scans, incremental, tokens, output_mode) = worker_matrix_config
+    (error, diff) = (None, io.StringIO())
+    try:
+        logger.info(f"matrix: tailoring {matrix_set} in to {output_dir}")
+        if output_mode == 'write':
+            os.makedirs(output_dir, exist_ok=True)
+        resolver = TailorResolver(defaults=parse_defaults(matrix_defaults), resolve_keys=resolvable_keys, ignore_keys=base_ignore_keys, configs=configs, tokens=tokens)
+        with contextlib.redirect_stdout(diff):
+            tailor_configs(resolver, tailor_file_scans, matrix_resolved_file_name, output_dir, 1, incremental, output_mode)
+    except TailorError as e:
+        error = str(e)
+    except Exception:
+        error = f"ERROR: could not tailor matrix set {matrix_set}\n{traceback.format_exc()}"
+    return (get_worker_log_records(), error, get_worker_profile(), diff.getvalue())
+
+
+#-------------------------------------------------------------------------------
+# read config files, with --serve parsed configs are kept and only read again
+# when the size or mtime of one of the files changed, config file urls are
+# revalidated on each request and compared by their cached copies
+#-------------------------------------------------------------------------------
+def get_configs(config_files: list, cache_dir: str = None, url_cache_dir: str = URL_CACHE_DIR, url_timeout: float = URL_TIMEOUT):
+    local_config_files = fetch_config_files(config_files, url_cache_dir, url_timeout)
+    if served_configs is None:
+        return read_config_files(config_files, cache_dir, local_config_files)
+    cache_key = tuple((config_file, os.path.abspath(config_file)) for config_file in config_files)
+    stamps = [get_file_stamp(local_config_file) for local_config_file in local_config_files]
+    if cache_key in served_configs and served_configs[cache_key][0] == stamps:
+        logger.debug("using parsed config files kept from an earlier request")
+        return served_configs[cache_key][1]
+    configs = read_config_files(config_files, cache_dir, local_config_files)
+    served_configs[cache_key] = (stamps, configs)
+    return configs
+
+
+#-------------------------------------------------------------------------------
+# resolve and tailor for parsed command line args
+#-------------------------------------------------------------------------------
+def run_tailor(args):
+    global profile
+    if args.profile:
+        profile = new_profile()
+    try:
+        with profile_phase('total'):
+            run_tailor_phases(args)
+    finally:
+        if args.profile:
+            write_profile(args.profile, args)
+            profile = None
+
+
+#-------------------------------------------------------------------------------
+# number of worker processes for --jobs, 0 for one per cpu
+#-------------------------------------------------------------------------------
+def get_jobs(jobs: int):
+    return os.cpu_count() if jobs == 0 else jobs
+
+
+#-------------------------------------------------------------------------------
+# parse, resolve and tailor
+#-------------------------------------------------------------------------------
+def run_tailor_phases(args):
+    jobs = get_jobs(args.jobs)
+    resolved_keys = parse_defaults(args.defaults)
+    resolvable_keys = get_resolvable_keys_list(args.resolve_keys)
+    if args.from_resolved and args.matrix:
+        raise TailorError("ERROR: --from-resolved can not be used with --matrix")
+    if args.clear_cache and args.cache_dir:
+        clear_config_cache(args.cache_dir)
+    (configs, config_map) = (None, None)
+    if args.from_resolved:
+        with profile_phase('read resolved file'):
+            config_map = read_resolved_file(args.from_resolved)
+    else:
+        with profile_phase('parse'):
+            configs = get_configs(args.config_files, args.cache_dir, args.url_cache_dir, args.url_timeout)
+    with profile_phase('glob'):
+        tailor_files = get_tailor_files(args.tailor_files, args.exclude_files)
+    with profile_phase('scan'):
+        tailor_file_scans = scan_tailor_files(tailor_files, jobs, args.incremental)
+    # tokens used in any tailor file, to only resolve keys needed for them
+    tokens = set().union(*[tokens for (_, tokens) in tailor_file_scans.values()]) if args.referenced_only else None
+    if args.matrix and args.output_dir:
+        raise TailorError("ERROR: --output-dir can not be used with --matrix, see --matrix-dir")
+    if args.matrix:
+        tailor_matrix(args.matrix, args.matrix_dir, configs, resolvable_keys, args.defaults, args.ignore_keys, tailor_file_scans,
+                      args.resolved_file, jobs, args.incremental, tokens, args.output_mode)
+    else:
+        resolver = TailorResolver(defaults=resolved_keys, resolve_keys=resolvable_keys, ignore_keys=args.ignore_keys, configs=configs, tokens=tokens, config_map=config_map)
+        tailor_configs(resolver, tailor_file_scans, args.resolved_file, args.output_dir, jobs, args.incremental, args.output_mode,
+                       write_resolved_file=not args.from_resolved)
+
+
+#-------------------------------------------------------------------------------
+# empty profile, phases and files hold wall and cpu time in seconds
+#-------------------------------------------------------------------------------
+def new_profile():
+    return {'phases': {}, 'counts': {}, 'files': {}}
+
+
+#-------------------------------------------------------------------------------
+# with --profile, add wall and cpu time of a phase to the profile. phases may
+# be entered more than once (e.g. each resolution pass) and include the time
+# of phases nested in them
+#-------------------------------------------------------------------------------
+@contextlib.contextmanager
+def profile_phase(phase: str):
+    if profile is None:
+        yield
+        return
+    (wall_start, cpu_start) = (time.perf_counter(), time.process_time())
+    try:
+        yield
+    finally:
+        phase_profile = profile['phases'].setdefault(phase, {'wall': 0.0, 'cpu': 0.0, 'count': 0})
+        phase_profile['wall'] += time.perf_counter() - wall_start
+        phase_profile['cpu'] += time.process_time() - cpu_start
+        phase_profile['count'] += 1
+
+
+#-------------------------------------------------------------------------------
+# with --profile, add to a counter of the profile
+#-------------------------------------------------------------------------------
+def count_profile(counter: str, count: int = 1):
+    if profile is not None:
+        profile['counts'][counter] = profile['counts'].get(counter, 0) + count
+
+
+#-------------------------------------------------------------------------------
+# with --profile, add wall and cpu time, bytes read and written and number of
+# tokens substituted for a tailored file to the profile, keyed by output file
+# as a tailor file is written more than once with --matrix
+# with output_mode 'dry-run' or 'diff' nothing is written
+#-------------------------------------------------------------------------------
+@contextlib.contextmanager
+def profile_file(tailor_file_name: str, new_tailor_file_name: str, output_mode: str = 'write'):
+    if profile is None:
+        yield
+        return
+    tokens_substituted = profile['counts'].get('tokens_substituted', 0)
+    (wall_start, cpu_start) = (time.perf_counter(), time.process_time())
+    yield
+    profile['files'][new_tailor_file_name] = {
+        'tailor_file': tailor_file_name,
+        'wall': time.perf_counter() - wall_start,
+        'cpu': time.process_time() - cpu_start,
+        'bytes_read': os.path.getsize(tailor_file_name),
+        'bytes_written': os.path.getsize(new_tailor_file_name) if output_mode == 'write' and os.path.isfile(new_tailor_file_name) else 0,
+        'tokens_substituted': profile['counts'].get('tokens_substituted', 0) - tokens_substituted
+    }
+
+
+#-------------------------------------------------------------------------------
+# add profile of a worker process to the profile
+#-------------------------------------------------------------------------------
+def merge_profile(worker_profile: dict):
+    if profile is None or worker_profile is None:
+        return
+    for (phase, phase_profile) in worker_profile['phases'].items():
+        total_profile = profile['phases'].setdefault(phase, {'wall': 0.0, 'cpu': 0.0, 'count': 0})
+        for measure in ['wall', 'cpu', 'count']:
+            total_profile[measure] += phase_profile[measure]
+    for (counter, count) in worker_profile['counts'].items():
+        count_profile(counter, count)
+    profile['files'].update(worker_profile['files'])
+
+
+#-------------------------------------------------------------------------------
+# yaml dump of a config node for debug messages, only call when debug messages
+# are written. the time is kept as a phase of its own, so its share of the
+# phases it is nested in can be seen
+#-------------------------------------------------------------------------------
+def debug_yaml_dump(config_node: map):
+    with profile_phase('debug yaml dump'):
+        return yaml.dump(config_node)
+
+
+#-------------------------------------------------------------------------------
+# write profile as json report, times of phases run in worker processes are
+# summed over all workers
+#-------------------------------------------------------------------------------
+def write_profile(profile_file_name: str, args):
+    logger.info(f"writing profile to {profile_file_name}")
+    report = {
+        'version': PROFILE_VERSION,
+        'args': vars(args),
+        'verbose': logger.isEnabledFor(logging.DEBUG),
+        'cpu_children': sum(os.times()[2:4]),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        **profile
+    }
+    with open(profile_file_name, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+#-------------------------------------------------------------------------------
+# raised in a server on SIGTERM, not an Exception so it is not handled as a
+# failed request but stops the server (the client of a running request gets
+# exit code 1)
+#-------------------------------------------------------------------------------
+class ServerTerminated(BaseException):
+    pass
+
+
+#-------------------------------------------------------------------------------
+# SIGTERM handler of a server
+#-------------------------------------------------------------------------------
+def terminate_server(signum, frame):
+    raise ServerTerminated()
+
+
+#-------------------------------------------------------------------------------
+# serve requests of tailor-client.py on a unix socket until terminated
+# the socket is only accessible by the user running the server
+#-------------------------------------------------------------------------------
+def serve_tailor_requests(socket_path: str):
+    global served_configs, served_config_maps
+    served_configs = {}
+    served_config_maps = {}
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            raise TailorError(f"ERROR: a server is already listening on {socket_path}")
+        except OSError:
+            # left behind by a server that was killed
+            os.remove(socket_path)
+        finally:
+            probe.close()
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, TailorRequestHandler)
+    finally:
+        os.umask(umask)
+    signal.signal(signal.SIGTERM, terminate_server)
+    logger.info(f"serving tailor requests on {socket_path}")
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, ServerTerminated):
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        logger.info(f"stopped serving tailor requests on {socket_path}")
+
+
+#-------------------------------------------------------------------------------
+# a request is a json line with the working directory and command line args of
+# the client, output is sent back as json lines {"stdout"|"stderr": text}
+# followed by {"exit": exit code}
+# requests are handled one at a time as they share the module globals
+#-------------------------------------------------------------------------------
+class TailorRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        start_time = time.perf_counter()
+        request = json.loads(self.rfile.readline())
+        try:
+            exit_code = serve_tailor_request(request['cwd'], request['args'], self.wfile)
+        except ServerTerminated:
+            logger.error(f"ERROR: server terminated while serving request in {request['cwd']}")
+            self.send_exit_code(1, "ERROR: tailor server terminated before request finished\n")
+            raise
+        self.send_exit_code(exit_code)
+        logger.info(f"served request in {request['cwd']} with exit code {exit_code} in {(time.perf_counter() - start_time) * 1000:.1f}ms")
+
+    # send exit code, after an error message not written by the request
+    def send_exit_code(self, exit_code: int, message: str = None):
+        try:
+            if message:
+                self.wfile.write((json.dumps({'stderr': message}) + '\n').encode())
+            self.wfile.write((json.dumps({'exit': exit_code}) + '\n').encode())
+        except OSError:
+            logger.warning("client disconnected before request finished")
+
+
+#-------------------------------------------------------------------------------
+# file like object sending text written to it to the client
+#-------------------------------------------------------------------------------
+class ClientStream:
+    def __init__(self, wfile, name: str):
+        self.wfile = wfile
+        self.name = name
+
+    def write(self, text: str):
+        if text:
+            self.wfile.write((json.dumps({self.name: text}) + '\n').encode())
+        return len(text)
+
+    def flush(self):
+        self.wfile.flush()
+
+
+#-------------------------------------------------------------------------------
+# run a single request in the working directory of the client with log
+# messages and output sent to the client, returns exit code
+#-------------------------------------------------------------------------------
+def serve_tailor_request(cwd: str, request_args: list, wfile):
+    client_stdout = ClientStream(wfile, 'stdout')
+    client_stderr = ClientStream(wfile, 'stderr')
+    client_handler = logging.StreamHandler(client_stderr)
+    client_handler.setFormatter(logging.Formatter(LOGGER_FORMAT))
+    (server_level, server_cwd) = (logger.level, os.getcwd())
+    logger.addHandler(client_handler)
+    logger.propagate = False
+    exit_code = 0
+    try:
+        with contextlib.redirect_stdout(client_stdout), contextlib.redirect_stderr(client_stderr):
+            # argparse exits on invalid args and --help, the only exit handled
+            # as exit code of the request
+            try:
+                request_parsed_args = parser.parse_args(request_args)
+                if not (request_parsed_args.config_files or request_parsed_args.from_resolved) or request_parsed_args.serve:
+                    parser.error("requests need --config-files or --from-resolved and can not use --serve")
+            except SystemExit as e:
+                return e.code if isinstance(e.code, int) else 1
+            logger.setLevel(logging.DEBUG if request_parsed_args.verbose else logging.INFO)
+            os.chdir(cwd)
+            run_tailor(request_parsed_args)
+    except TailorError as e:
+        logger.error(f"{e}")
+        exit_code = 1
+    except Exception:
+        logger.error("ERROR: could not run request", exc_info=True)
+        exit_code = 1
+    finally:
+        os.chdir(server_cwd)
+        logger.removeHandler(client_handler)
+        logger.propagate = True
+        logger.setLevel(server_level)
+    return exit_code
 
 
 #-------------------------------------------------------------------------------
 # Run
 #-------------------------------------------------------------------------------
 if __name__ == "__main__":
+    try:
+        args = parser.parse_args()
+    except Exception:
+        parser.print_help()
+        sys.exit(traceback.print_exc())
+    if not args.config_files and not args.serve and not args.from_resolved:
+        parser.error("the following arguments are required: --config-files")
     logger = setup_logger(args.verbose)
-    resolved_keys = parse_defaults(args.defaults)
-    resolvable_keys = get_resolvable_keys_list(args.resolve_keys)
-    ignore_keys = args.ignore_keys
-    # config_files = get_config_files(args.config_files)
-    # configs = read_config_files(config_files)
-    configs = read_config_files(args.config_files)
-    resolved_config = resolve_configs(resolvable_keys, copy.deepcopy(configs), resolved_keys)
-    config_map = consolidate_configs(resolved_config, resolved_keys)
-    # check if config map has a key default.ignore_keys and if so, add to ignore_keys
-    if 'ignore_keys' in config_map['config']:
-        ignore_keys = ignore_keys + re.split(',',config_map['config']['ignore_keys'])
-    print_config_map(args.resolved_file, config_map)
-    tailor_files = get_tailor_files(args.tailor_files)
-    substitue_keys_in_tailor_files(tailor_files, config_map)
+    try:
+        if args.serve:
+            serve_tailor_requests(args.serve)
+        else:
+            run_tailor(args)
+    except TailorError as e:
+        logger.error(f"{e}")
+        sys.exit(1)
     sys.exit(0)